@@ -0,0 +1,95 @@
+"""Decryption of bursts of chat messages on a pool of worker processes
+
+Pure Python AES holds the GIL, so the hundreds of messages of a reconnect
+backlog are decrypted one after the other whatever the number of threads.
+BatchDecryptor shards them over processes instead, each of which sets up the
+key schedule once when it starts, and hands the plaintexts back in order,
+chunk by chunk as they are decrypted.
+
+Jobs are (kind, body) pairs, kind being how the message was received:
+'msg' for base64 encoded AES-OFB, 'encrypted' for raw AES-OFB and 'ctr' for
+the session cipher, body starting with its header extension. v2 plaintext,
+kind 'plain', has nothing to decrypt and is never handed over."""
+import base64
+import concurrent.futures
+import multiprocessing
+import os
+
+import cipher
+import protocol
+import pyaes
+
+KINDS = ('msg', 'encrypted', 'ctr')
+WORKERS = os.cpu_count() or 1
+# More chunks than workers, so that the first plaintexts come back early
+CHUNKS_PER_WORKER = 4
+# Keystream generated when a worker starts, longer than most chat lines
+WARM_KEYSTREAM = 4 * 1024
+
+# State of a worker process, set up by start_worker
+_key = None
+_aes = None
+_ofb_keystream = b''
+
+
+def start_worker(key):
+    """Set a worker process up: key schedule, and keystream of AES-OFB with its fixed IV"""
+    global _key, _aes
+    _key = key
+    _aes = pyaes.AES(key)
+    ofb_keystream(WARM_KEYSTREAM)
+
+
+def ofb_keystream(size):
+    """Return at least size bytes of AES-OFB keystream, the same for every message as the IV is fixed"""
+    global _ofb_keystream
+    if len(_ofb_keystream) < size:
+        _ofb_keystream = pyaes.AESModeOfOperationOFB(_key).encrypt(bytes(max(size, 2 * len(_ofb_keystream))))
+    return _ofb_keystream
+
+
+def decrypt_job(kind, body):
+    if kind == 'ctr':
+        nonce, counter, ciphertext = protocol.decode_ctr_extension(body)
+        stream = cipher.keystream(_aes, bytes(nonce), counter, cipher.counter_blocks(len(ciphertext)))
+        return cipher.xor(ciphertext, stream)
+    ciphertext = body if kind == 'encrypted' else base64.b64decode(body)
+    return cipher.xor(ciphertext, ofb_keystream(len(ciphertext)))
+
+
+def decrypt_chunk(jobs):
+    """Return the plaintexts of jobs, None for the ones that don't decrypt"""
+    plaintexts = []
+    for kind, body in jobs:
+        try:
+            plaintexts.append(decrypt_job(kind, body))
+        except Exception:
+            plaintexts.append(None)
+    return plaintexts
+
+
+class BatchDecryptor(object):
+    def __init__(self, key, workers=WORKERS):
+        self.workers = workers
+        # Spawned, not forked: the client process runs Tk and threads
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'), initializer=start_worker, initargs=(key,))
+
+    def submit(self, jobs):
+        """Return, for every job, the future of the chunk it is decrypted in and its index in that chunk"""
+        chunk_size = max(1, -(-len(jobs) // (self.workers * CHUNKS_PER_WORKER)))
+        slots = []
+        for start in range(0, len(jobs), chunk_size):
+            chunk = [(kind, bytes(body) if isinstance(body, memoryview) else body)
+                     for kind, body in jobs[start:start + chunk_size]]
+            future = self.executor.submit(decrypt_chunk, chunk)
+            slots.extend((future, index) for index in range(len(chunk)))
+        return slots
+
+    def decrypt(self, jobs):
+        """Yield the plaintexts of jobs in order, each as soon as its chunk is decrypted"""
+        for future, index in self.submit(jobs):
+            yield future.result()[index]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,40 @@
+"""Microbenchmark: list-based AES.encrypt/decrypt vs the word-level *_block_into engine"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pyaes
+
+ROUNDS = 20000
+
+
+def bench(label, func):
+    seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+    print('  %-28s %8.2f us/block %10.0f blocks/s' % (label, seconds / ROUNDS * 1e6, ROUNDS / seconds))
+    return seconds
+
+
+def main():
+    for key_size in (16, 24, 32):
+        aes = pyaes.AES(os.urandom(key_size))
+        block = os.urandom(16)
+        out = bytearray(16)
+
+        # Both engines must agree before timing them
+        aes.encrypt_block_into(block, out)
+        assert bytes(out) == bytes(aes.encrypt(block))
+        aes.decrypt_block_into(block, out)
+        assert bytes(out) == bytes(aes.decrypt(block))
+
+        print('AES-%d' % (key_size * 8))
+        old = bench('encrypt', lambda: aes.encrypt(block))
+        new = bench('encrypt_block_into', lambda: aes.encrypt_block_into(block, out))
+        print('  speedup x%.2f' % (old / new))
+        old = bench('decrypt', lambda: aes.decrypt(block))
+        new = bench('decrypt_block_into', lambda: aes.decrypt_block_into(block, out))
+        print('  speedup x%.2f' % (old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark: catching up on a backlog of encrypted messages, one by one vs on worker processes
+
+Decrypts a backlog of base64 encoded AES-OFB messages, as the text protocol
+delivers them, or of session cipher messages, the way
+ChatWindow.beautify_message does one message at a time, then with
+batch.BatchDecryptor for every worker count up to the number of cores.
+Reports the time to the first and to the last plaintext; worker start up is
+excluded, the client starts its pool once and keeps it. With OFB and its fixed
+IV, workers reuse the same keystream for every message, session cipher
+messages each need keystream of their own."""
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import batch
+import cipher
+import protocol
+import pyaes
+
+KEY = b'This_key_for_demo_purposes_only!'
+
+
+def backlog(kind, count, size):
+    plaintexts = [os.urandom(size) for _ in range(count)]
+    if kind == 'ctr':
+        session = cipher.SessionCipher(KEY, reservoir_size=0)
+        jobs = []
+        for data in plaintexts:
+            counter, ciphertext = session.encrypt(data)
+            jobs.append(('ctr', protocol.encode_ctr_extension(session.nonce, counter) + ciphertext))
+        session.close()
+    else:
+        jobs = [('msg', base64.b64encode(pyaes.AESModeOfOperationOFB(KEY).encrypt(data))) for data in plaintexts]
+    return plaintexts, jobs
+
+
+def decrypt(kind, body):
+    if kind == 'ctr':
+        nonce, counter, ciphertext = protocol.decode_ctr_extension(body)
+        initial_value = int.from_bytes(nonce + counter.to_bytes(8, 'big'), 'big')
+        return pyaes.AESModeOfOperationCTR(KEY, pyaes.Counter(initial_value)).decrypt(ciphertext)
+    return pyaes.AESModeOfOperationOFB(KEY).decrypt(base64.b64decode(body))
+
+
+def one_by_one(jobs):
+    start = time.perf_counter()
+    first = None
+    plaintexts = []
+    for kind, body in jobs:
+        plaintexts.append(decrypt(kind, body))
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start, plaintexts
+
+
+def on_workers(decryptor, jobs):
+    start = time.perf_counter()
+    first = None
+    plaintexts = []
+    for plaintext in decryptor.decrypt(jobs):
+        plaintexts.append(plaintext)
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start, plaintexts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--size', type=int, default=200, help='bytes per message')
+    parser.add_argument('--kind', choices=('msg', 'ctr'), default='msg', help='base64 AES-OFB or session cipher')
+    parser.add_argument('--workers', type=int, default=batch.WORKERS, help='up to this many worker processes')
+    options = parser.parse_args()
+
+    expected, jobs = backlog(options.kind, options.messages, options.size)
+    print('%d messages of %d bytes, %d cores' % (options.messages, options.size, os.cpu_count() or 1))
+    first, last, plaintexts = one_by_one(jobs)
+    assert plaintexts == expected
+    print('%-12s first %8.1f ms  all %8.1f ms' % ('one by one', first * 1e3, last * 1e3))
+    for workers in range(1, options.workers + 1):
+        decryptor = batch.BatchDecryptor(KEY, workers)
+        # Started and warmed up before the backlog comes in
+        list(decryptor.decrypt(jobs[:workers]))
+        first, elapsed, plaintexts = on_workers(decryptor, jobs)
+        decryptor.close()
+        assert plaintexts == expected
+        print('%-12s first %8.1f ms  all %8.1f ms  %5.1fx' %
+              ('%d worker%s' % (workers, 's' if workers > 1 else ''), first * 1e3, elapsed * 1e3, last / elapsed))
+
+
+if __name__ == '__main__':
+    main()
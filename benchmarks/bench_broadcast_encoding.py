@@ -0,0 +1,96 @@
+"""Benchmark: cost of fanning a broadcast out to many connections in server.py
+
+Broadcasts to connections whose socket writer is stubbed out, half of them
+framed and half text, and checks that every recipient is queued the very same
+bytes object. The server counters and tracemalloc show how many encodes and
+how many bytes were allocated per recipient, compared to encoding the message
+again for every recipient as server.js does."""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+from framing import encode_frame
+
+
+class StubWriter(object):
+    def __init__(self, index):
+        self.peer = ('10.0.%d.%d' % (index // 256, index % 256), 40000 + index)
+
+    def get_extra_info(self, name):
+        return self.peer if name == 'peername' else None
+
+    def close(self):
+        pass
+
+
+def connect(chat_server, count):
+    connections = []
+    for index in range(count):
+        connection = server.Connection(chat_server, None, StubWriter(index))
+        connection.framed = index % 2 == 1
+        chat_server.connections.add(connection)
+        connections.append(connection)
+    return connections
+
+
+def drain(connections):
+    """Empty the queues, return the distinct objects that were queued"""
+    queued = {}
+    for connection in connections:
+        while not connection.queue.empty():
+            data = connection.queue.get_nowait()
+            queued[id(data)] = data
+    return queued
+
+
+def legacy_broadcast(chat_server, data, sender=None):
+    """Encode per recipient, like the server did before"""
+    for connection in chat_server.connections:
+        if connection is not sender:
+            payload = bytes(bytearray(data))
+            connection.queue.put_nowait(encode_frame(payload) if connection.framed else payload)
+
+
+async def run(recipients, messages, body_size):
+    chat_server = server.ChatServer(queue_size=messages + 1)
+    connections = connect(chat_server, recipients + 1)
+    sender = connections[0]
+    data = b'msg;sender;ALL;' + b'x' * body_size + b'\n'
+    results = {}
+
+    for label, broadcast in (('per recipient', legacy_broadcast),
+                             ('encoded once', lambda s, d, c: s.broadcast(sender.prefix + d, c))):
+        chat_server.stats.clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(messages):
+            broadcast(chat_server, data, sender)
+        elapsed = time.perf_counter() - start
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        distinct = len(drain(connections))
+        results[label] = elapsed
+        print('%-14s %d recipients x %d messages: %.1f us per message, %d distinct buffers queued, '
+              '%.1f bytes held per delivery' % (label, recipients, messages, elapsed / messages * 1e6, distinct,
+                                                allocated / float(recipients * messages)))
+        if chat_server.stats:
+            print('%-14s %s' % ('', ', '.join('%s %d' % item for item in sorted(chat_server.stats.items()))))
+    print('speedup x%.1f' % (results['per recipient'] / results['encoded once']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--body-size', type=int, default=64)
+    options = parser.parse_args()
+    asyncio.run(run(options.recipients, options.messages, options.body_size))
+
+
+if __name__ == '__main__':
+    main()
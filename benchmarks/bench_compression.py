@@ -0,0 +1,100 @@
+"""Benchmark: compression ratio and CPU cost of chat message bodies
+
+Generates a synthetic chat corpus, then compresses every message on its own
+without a dictionary, on its own with the preset dictionary of
+compression.py, and with one streaming compressor flushed after every
+message, as a per-connection compressor would. Reports the size of the
+compressed corpus relative to the original and the time spent per message."""
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compression
+
+WORDS = ('I', 'you', 'we', 'the', 'a', 'to', 'and', 'is', 'it', 'that', 'for', 'on', 'with', 'this', 'have',
+         'just', 'know', 'think', 'really', 'good', 'great', 'work', 'meeting', 'today', 'tomorrow', 'later',
+         'code', 'server', 'client', 'bug', 'fix', 'test', 'push', 'merge', 'review', 'deploy', 'lunch',
+         'coffee', 'weekend', 'home', 'sure', 'maybe', 'now', 'here', 'there', 'what', 'when', 'why', 'how')
+PHRASES = ('hello everyone', 'how are you doing?', 'see you later', 'thanks!', 'lol', 'ok', 'sounds good',
+           'let me know', 'I don\'t know', 'are you there?', 'can you review https://github.com/org/repo/pull/%d',
+           'brb', 'good morning :)', 'I\'ll be late today')
+
+
+def corpus(count, seed=42):
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        if rng.random() < 0.4:
+            text = rng.choice(PHRASES)
+            if '%d' in text:
+                text = text % rng.randint(1, 999)
+        else:
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+        messages.append(text.encode('utf-8'))
+    return messages
+
+
+def per_message(zdict):
+    def compress(data):
+        if zdict:
+            compressor = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, compression.WINDOW_BITS,
+                                          compression.MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+        else:
+            compressor = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, compression.WINDOW_BITS,
+                                          compression.MEM_LEVEL)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(data):
+        if zdict:
+            decompressor = zlib.decompressobj(compression.WINDOW_BITS, zdict=zdict)
+        else:
+            decompressor = zlib.decompressobj(compression.WINDOW_BITS)
+        return decompressor.decompress(data) + decompressor.flush()
+    return compress, decompress
+
+
+def streaming():
+    """One compressor and one decompressor for the whole conversation, flushed after every message"""
+    compressor = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, compression.WINDOW_BITS, compression.MEM_LEVEL)
+    decompressor = zlib.decompressobj(compression.WINDOW_BITS)
+
+    def compress(data):
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compress, decompressor.decompress
+
+
+def measure(label, messages, compress, decompress):
+    start = time.perf_counter()
+    compressed = [compress(data) for data in messages]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decompressed = [decompress(data) for data in compressed]
+    decompress_time = time.perf_counter() - start
+    assert decompressed == messages
+    original = sum(len(data) for data in messages)
+    size = sum(len(data) for data in compressed)
+    print('%-22s %6.1f%% of original, %5.1f bytes per message, compress %5.1f us, decompress %5.1f us' %
+          (label, 100.0 * size / original, size / float(len(messages)), compress_time / len(messages) * 1e6,
+           decompress_time / len(messages) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    options = parser.parse_args()
+
+    messages = corpus(options.messages)
+    print('%d messages, %.1f bytes per message' % (len(messages), sum(map(len, messages)) / float(len(messages))))
+    measure('no dictionary', messages, *per_message(None))
+    measure('preset dictionary', messages, *per_message(compression.DICTIONARY))
+    measure('streaming, sync flush', messages, *streaming())
+    # What clients actually send: only compressed when it is smaller, with its marker byte
+    measure('compression.compress', messages, compression.compress, compression.decompress)
+
+
+if __name__ == '__main__':
+    main()
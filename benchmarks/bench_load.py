@@ -0,0 +1,310 @@
+"""Benchmark: end-to-end latency and throughput of the chat stack under load
+
+Starts a server (server.py or server.js) in a subprocess and connects N
+simulated users to it, all of them chatclient.ChatClient instances driven by
+one ClientLoop, speaking the text protocol by default (#pseudo=,
+msg;login;target;body) or framed or v2. They send broadcasts and private
+messages at a given total rate, optionally encrypted with AES-OFB as gui.py
+does, each body carrying its send time.
+
+Reports the end-to-end latency percentiles of every delivery, deliveries per
+second, messages lost, server RSS and CPU time from /proc (the whole process
+tree, for sharded servers) and bytes on the wire, and writes them as JSON
+with --json so that runs can be compared between releases."""
+import argparse
+import base64
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import compression
+import pyaes
+from chatclient import ChatClient, ClientLoop, Listener
+from framing import FRAMED
+
+HOST = '127.0.0.1'
+PORT = 5700
+KEY = b'This_key_for_demo_purposes_only!'
+# Protocols the simulated users may pick, by --wire
+WIRES = {'text': (), 'framed': (FRAMED,), 'v2': None}
+# Time the sender checks for messages due
+TICK = 0.005
+
+
+class Recorder(Listener):
+    """Latency of every chat message delivered to the simulated users"""
+
+    def __init__(self, key):
+        self.key = key
+        self.latencies = []
+        self.corrupted = 0
+        self.disconnected = 0
+        self.lock = threading.Lock()
+
+    def on_chat(self, client, msg):
+        now = time.perf_counter_ns()
+        kind, body = msg[0], msg[3]
+        try:
+            if self.key and kind != 'plain':
+                # Base64 encoded by the text protocol, raw with v2
+                ciphertext = base64.b64decode(body) if kind == 'msg' else bytes(body)
+                body = pyaes.AESModeOfOperationOFB(self.key).decrypt(ciphertext)
+            elif isinstance(body, str):
+                body = body.encode()
+            sent = int(compression.decompress(bytes(body)).split(b':', 1)[0], 16)
+        except ValueError:
+            self.corrupted += 1
+            return
+        with self.lock:
+            self.latencies.append(now - sent)
+
+    def on_disconnect(self, client, reason, alert):
+        self.disconnected += 1
+
+
+def start_server(kind, port, workers, queue_size):
+    if kind == 'node':
+        # server.js listens on its own fixed port, and dies writing to a client that just left: it is ready once it
+        # says so rather than once a connection succeeds
+        server = subprocess.Popen(['node', os.path.join(ROOT, 'server.js')], stdout=subprocess.PIPE, cwd=ROOT)
+        running = threading.Event()
+
+        def read_log():
+            for line in server.stdout:
+                if b'running' in line:
+                    running.set()
+        threading.Thread(target=read_log, daemon=True).start()
+        if not running.wait(10):
+            server.kill()
+            raise RuntimeError('server did not start')
+        return server
+
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--host', HOST, '--port', str(port),
+                               '--workers', str(workers), '--queue-size', str(queue_size)],
+                              stdout=subprocess.DEVNULL, cwd=ROOT)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError('server did not start')
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants"""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open('/proc/%d/task/%d/children' % (parent, parent)) as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def server_usage(pid):
+    """Return RSS and peak RSS in KB and CPU seconds of the server process tree, None where /proc isn't there"""
+    usage = {'rss_kb': 0, 'peak_rss_kb': 0, 'cpu_s': 0.0}
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    try:
+        for process in process_tree(pid):
+            with open('/proc/%d/status' % process) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        usage['rss_kb'] += int(line.split()[1])
+                    elif line.startswith('VmHWM:'):
+                        usage['peak_rss_kb'] += int(line.split()[1])
+            with open('/proc/%d/stat' % process) as stat:
+                # Fields after the command name, which may hold spaces: utime and stime are the 12th and 13th
+                fields = stat.read().rsplit(')', 1)[1].split()
+                usage['cpu_s'] += (int(fields[11]) + int(fields[12])) / float(ticks)
+    except OSError:
+        return None
+    return usage
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def connect_users(count, port, wire, recorder):
+    loop = ClientLoop()
+    users = []
+    for index in range(count):
+        user = ChatClient(HOST, port, recorder, WIRES[wire])
+        if not user.connect_to_server():
+            raise RuntimeError('could not connect user %d' % index)
+        loop.add(user)
+        user.set_pseudo('user%d' % index)
+        users.append(user)
+    loop.start()
+    # Negotiated, and with v2 every user knows the id of every other one
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if all(user.protocol is not None for user in users):
+            if wire != 'v2' or all(len(user.login_list) > count for user in users):
+                break
+        time.sleep(0.05)
+    return loop, users
+
+
+def body(size, key):
+    data = b'%x:' % time.perf_counter_ns()
+    data += b'x' * max(0, size - len(data))
+    if key:
+        return pyaes.AESModeOfOperationOFB(key).encrypt(data)
+    return data
+
+
+def drive(users, rate, duration, size, private_ratio, key, rng):
+    """Send rate messages per second for duration seconds, return (sent, deliveries expected)"""
+    sent = expected = 0
+    kind = 'encrypted' if key else 'msg'
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+        for _ in range(int(elapsed * rate) - sent):
+            sender = users[sent % len(users)]
+            if rng.random() < private_ratio:
+                target = rng.choice(users)
+                while target is sender:
+                    target = rng.choice(users)
+                sender.send(target.login, body(size, key), kind)
+                expected += 1
+            else:
+                sender.send('ALL', body(size, key), kind)
+                expected += len(users) - 1
+            sent += 1
+        time.sleep(TICK)
+    return sent, expected
+
+
+def run(options):
+    server = None
+    port = 5000 if options.server == 'node' else options.port
+    if options.server != 'none':
+        server = start_server(options.server, port, options.workers, options.queue_size)
+    key = KEY if options.encrypt else None
+    recorder = Recorder(key)
+    try:
+        loop, users = connect_users(options.clients, port, options.wire, recorder)
+        time.sleep(options.settle)
+        before = server_usage(server.pid) if server else None
+        received_before = sum(user.stats['bytes_received'] for user in users)
+        sent_before = sum(user.stats['bytes'] for user in users)
+
+        start = time.perf_counter()
+        sent, expected = drive(users, options.rate, options.duration, options.size, options.private_ratio, key,
+                               random.Random(options.seed))
+        # Until everything sent is delivered, or it won't be
+        deadline = time.perf_counter() + options.drain
+        while len(recorder.latencies) < expected and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        after = server_usage(server.pid) if server else None
+        bytes_sent = sum(user.stats['bytes'] for user in users) - sent_before
+        bytes_received = sum(user.stats['bytes_received'] for user in users) - received_before
+        protocols = sorted(set(str(user.protocol) for user in users))
+        loop.close()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(recorder.latencies)
+    delivered = len(latencies)
+    milliseconds = [latency / 1e6 for latency in latencies]
+    if after and before:
+        after['cpu_s'] = round(after['cpu_s'] - before['cpu_s'], 3)
+    return {
+        'config': {name: value for name, value in vars(options).items() if name != 'json'},
+        'protocols': protocols,
+        'messages_sent': sent,
+        'deliveries_expected': expected,
+        'deliveries': delivered,
+        'lost': expected - delivered,
+        'corrupted': recorder.corrupted,
+        'disconnected': recorder.disconnected,
+        'elapsed_s': round(elapsed, 3),
+        'messages_per_s': round(sent / elapsed, 1),
+        'deliveries_per_s': round(delivered / elapsed, 1),
+        'latency_ms': {
+            'p50': percentile(milliseconds, 0.50),
+            'p99': percentile(milliseconds, 0.99),
+            'p999': percentile(milliseconds, 0.999),
+            'max': milliseconds[-1] if milliseconds else None,
+            'mean': sum(milliseconds) / delivered if delivered else None,
+        },
+        'wire_bytes': {
+            'sent': bytes_sent,
+            'received': bytes_received,
+            'received_per_delivery': round(bytes_received / float(delivered), 1) if delivered else None,
+        },
+        'server': after,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('python', 'node', 'none'), default='python',
+                        help='server to start, none to use one already listening on --port')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=1, help='server.py worker processes')
+    parser.add_argument('--queue-size', type=int, default=100000, help='server.py per connection queue size')
+    parser.add_argument('--wire', choices=sorted(WIRES), default='text')
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=20.0, help='messages per second, all users together')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending')
+    parser.add_argument('--size', type=int, default=64, help='message body size in bytes')
+    parser.add_argument('--private-ratio', type=float, default=0.0, help='share of private messages')
+    parser.add_argument('--encrypt', action='store_true', help='AES-OFB encrypted bodies, as gui.py sends them')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds between connecting and sending')
+    parser.add_argument('--drain', type=float, default=10.0, help='seconds to wait for late deliveries')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='write the results to this file, - for stdout')
+    options = parser.parse_args()
+
+    results = run(options)
+    if options.json == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    latency = results['latency_ms']
+    print('%d users (%s), %d messages sent, %d/%d deliveries, %d lost' %
+          (options.clients, ','.join(results['protocols']), results['messages_sent'], results['deliveries'],
+           results['deliveries_expected'], results['lost']))
+    if results['deliveries']:
+        print('latency ms   p50 %.2f  p99 %.2f  p99.9 %.2f  max %.2f' %
+              (latency['p50'], latency['p99'], latency['p999'], latency['max']))
+    print('throughput   %.1f messages/s, %.1f deliveries/s' %
+          (results['messages_per_s'], results['deliveries_per_s']))
+    print('wire         %d bytes sent, %d received, %s per delivery' %
+          (results['wire_bytes']['sent'], results['wire_bytes']['received'],
+           results['wire_bytes']['received_per_delivery']))
+    if results['server']:
+        print('server       RSS %d KB (peak %d KB), %.2f s CPU' %
+              (results['server']['rss_kb'], results['server']['peak_rss_kb'], results['server']['cpu_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Benchmark: AES-OFB throughput of the legacy per-byte loop vs the block-wise implementation"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pyaes
+
+SIZES = [('1 KB', 1024), ('64 KB', 64 * 1024), ('1 MB', 1024 * 1024)]
+
+
+class LegacyOFB(object):
+    """The original AESModeOfOperationOFB.encrypt loop: one pop(0) per byte"""
+
+    def __init__(self, key, iv=None):
+        self._aes = pyaes.AES(key)
+        self._last_precipherblock = [0] * 16 if iv is None else list(iv)
+        self._remaining_block = []
+
+    def encrypt(self, plaintext):
+        encrypted = []
+        for p in plaintext:
+            if len(self._remaining_block) == 0:
+                self._remaining_block = self._aes.encrypt(self._last_precipherblock)
+                self._last_precipherblock = []
+            precipherbyte = self._remaining_block.pop(0)
+            self._last_precipherblock.append(precipherbyte)
+            encrypted.append(p ^ precipherbyte)
+        return bytes(encrypted)
+
+
+def throughput(mode_class, key, data):
+    """Return (MB/s, ciphertext) for encrypting data with a fresh mode object"""
+    start = time.perf_counter()
+    ciphertext = mode_class(key).encrypt(data)
+    elapsed = time.perf_counter() - start
+    return len(data) / elapsed / (1024 * 1024), ciphertext
+
+
+def main():
+    key = b'This_key_for_demo_purposes_only!'
+    print('%-8s %12s %12s %9s' % ('size', 'before MB/s', 'after MB/s', 'speedup'))
+    for label, size in SIZES:
+        data = os.urandom(size)
+        before, expected = throughput(LegacyOFB, key, data)
+        after, ciphertext = throughput(pyaes.AESModeOfOperationOFB, key, data)
+        # Messages encrypted by the old class must still decrypt
+        assert ciphertext == expected
+        assert pyaes.AESModeOfOperationOFB(key).decrypt(expected) == data
+        print('%-8s %12.3f %12.3f %8.1fx' % (label, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark: bytes sent to clients for private messages, broadcast-and-filter vs server-side routing
+
+Starts server.ChatServer in process, connects simulated text protocol clients,
+has every client send private messages to random other clients and counts the
+bytes all clients receive."""
+import argparse
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+SETTLE_TIME = 0.5
+
+
+class SimulatedClient(object):
+    def __init__(self, pseudo):
+        self.pseudo = pseudo
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self.task = None
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            self.received += len(data)
+
+    def send(self, data):
+        self.writer.write(data)
+
+    async def close(self):
+        self.writer.close()
+        self.task.cancel()
+
+
+async def run(clients_count, messages_per_client, route_private):
+    chat_server = server.ChatServer('127.0.0.1', 0, queue_size=1000000, route_private=route_private)
+    listener = await chat_server.start()
+    port = listener.sockets[0].getsockname()[1]
+
+    clients = [SimulatedClient('user%d' % i) for i in range(clients_count)]
+    for client in clients:
+        await client.connect(port)
+    await asyncio.sleep(SETTLE_TIME)
+    for client in clients:
+        client.send(('#pseudo=' + client.pseudo).encode())
+    await asyncio.sleep(SETTLE_TIME)
+
+    for client in clients:
+        client.received = 0
+    sent = 0
+    rng = random.Random(42)
+    for _ in range(messages_per_client):
+        for client in clients:
+            target = rng.choice(clients)
+            while target is client:
+                target = rng.choice(clients)
+            data = ('msg;%s;%s;%s\n' % (client.pseudo, target.pseudo, 'hello ' * 8)).encode()
+            client.send(data)
+            sent += len(data)
+        # One chunk per message in the text protocol, don't let writes coalesce
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(SETTLE_TIME)
+
+    received = sum(client.received for client in clients)
+    for client in clients:
+        await client.close()
+    # Let the server see every disconnection before it goes away
+    await asyncio.sleep(SETTLE_TIME)
+    listener.close()
+    await listener.wait_closed()
+    return sent, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=2, help='private messages sent by each client')
+    options = parser.parse_args()
+
+    results = {}
+    for label, route_private in (('broadcast', False), ('routed', True)):
+        sent, received = asyncio.run(run(options.clients, options.messages, route_private))
+        results[label] = received
+        print('%-10s %d clients, %d bytes sent, %d bytes received by clients' %
+              (label, options.clients, sent, received))
+    print('reduction x%.1f' % (results['broadcast'] / float(results['routed'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""Benchmark and known-answer check of pyaes: the block cipher and every mode, for every key size
+
+First checks AES.encrypt/decrypt, the *_block_into engine and the ECB, CBC,
+CFB (8 and 128 bit segments), OFB and CTR modes against the NIST SP800-38A
+example vectors, for 128, 192 and 256 bit keys, encrypting and decrypting
+in one call and in uneven pieces. Then times the block cipher and each
+mode's encrypt and decrypt, in blocks/s and MB/s.
+
+With --save-baseline the timings are written to a JSON file, which later
+runs compare against with --baseline (pyaes_baseline.json next to this
+script by default): every timing is reported relative to the baseline and
+the ones slower by more than --tolerance are flagged. Exits with status 1 if
+a vector doesn't match, or if something got slower and --strict is given."""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import pyaes
+
+BASELINE = os.path.join(HERE, 'pyaes_baseline.json')
+BLOCK_SIZE = 16
+
+# NIST SP800-38A, appendix F
+KEYS = {
+    128: '2b7e151628aed2a6abf7158809cf4f3c',
+    192: '8e73b0f7da0e6452c810f32b809079e562f8ead2522c6b7b',
+    256: '603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4',
+}
+PLAINTEXT = ('6bc1bee22e409f96e93d7e117393172a' 'ae2d8a571e03ac9c9eb76fac45af8e51'
+             '30c81c46a35ce411e5fbc1191a0a52ef' 'f69f2445df4f9b17ad2b417be66c3710')
+IV = '000102030405060708090a0b0c0d0e0f'
+INITIAL_COUNTER = 'f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff'
+# (mode, segment size in bytes for CFB) to key size to ciphertext, of the whole PLAINTEXT but for CFB8
+CIPHERTEXTS = {
+    ('ecb', None): {
+        128: '3ad77bb40d7a3660a89ecaf32466ef97' 'f5d3d58503b9699de785895a96fdbaaf'
+             '43b1cd7f598ece23881b00e3ed030688' '7b0c785e27e8ad3f8223207104725dd4',
+        192: 'bd334f1d6e45f25ff712a214571fa5cc' '974104846d0ad3ad7734ecb3ecee4eef'
+             'ef7afd2270e2e60adce0ba2face6444e' '9a4b41ba738d6c72fb16691603c18e0e',
+        256: 'f3eed1bdb5d2a03c064b5a7e3db181f8' '591ccb10d410ed26dc5ba74a31362870'
+             'b6ed21b99ca6f4f9f153e7b1beafed1d' '23304b7a39f9f3ff067d8d8f9e24ecc7',
+    },
+    ('cbc', None): {
+        128: '7649abac8119b246cee98e9b12e9197d' '5086cb9b507219ee95db113a917678b2'
+             '73bed6b8e3c1743b7116e69e22229516' '3ff1caa1681fac09120eca307586e1a7',
+        192: '4f021db243bc633d7178183a9fa071e8' 'b4d9ada9ad7dedf4e5e738763f69145a'
+             '571b242012fb7ae07fa9baac3df102e0' '08b0e27988598881d920a9e64f5615cd',
+        256: 'f58c4c04d6e5f1ba779eabfb5f7bfbd6' '9cfc4e967edb808d679f777bc6702c7d'
+             '39f23369a9d9bacfa530e26304231461' 'b2eb05e2c39be9fcda6c19078c6a9d1b',
+    },
+    ('cfb', 1): {
+        128: '3b79424c9c0dd436bace9e0ed4586a4f32b9',
+        192: 'cda2521ef0a905ca44cd057cbf0d47a0678a',
+        256: 'dc1f1a8520a64db55fcc8ac554844e889700',
+    },
+    ('cfb', 16): {
+        128: '3b3fd92eb72dad20333449f8e83cfb4a' 'c8a64537a0b3a93fcde3cdad9f1ce58b'
+             '26751f67a3cbb140b1808cf187a4f4df' 'c04b05357c5d1c0eeac4c66f9ff7f2e6',
+        192: 'cdc80d6fddf18cab34c25909c99a4174' '67ce7f7f81173621961a2b70171d3d7a'
+             '2e1e8a1dd59b88b1c8e60fed1efac4c9' 'c05f9f9ca9834fa042ae8fba584b09ff',
+        256: 'dc7e84bfda79164b7ecd8486985d3860' '39ffed143b28b1c832113c6331e5407b'
+             'df10132415e54b92a13ed0a8267ae2f9' '75a385741ab9cef82031623d55b1e471',
+    },
+    ('ofb', None): {
+        128: '3b3fd92eb72dad20333449f8e83cfb4a' '7789508d16918f03f53c52dac54ed825'
+             '9740051e9c5fecf64344f7a82260edcc' '304c6528f659c77866a510d9c1d6ae5e',
+        192: 'cdc80d6fddf18cab34c25909c99a4174' 'fcc28b8d4c63837c09e81700c1100401'
+             '8d9a9aeac0f6596f559c6d4daf59a5f2' '6d9f200857ca6c3e9cac524bd9acc92a',
+        256: 'dc7e84bfda79164b7ecd8486985d3860' '4febdc6740d20b3ac88f6ad82a4fb08d'
+             '71ab47a086e86eedf39d1c5bba97c408' '0126141d67f37be8538f5a8be740e484',
+    },
+    ('ctr', None): {
+        128: '874d6191b620e3261bef6864990db6ce' '9806f66b7970fdff8617187bb9fffdff'
+             '5ae4df3edbd5d35e5b4f09020db03eab' '1e031dda2fbe03d1792170a0f3009cee',
+        192: '1abc932417521ca24f2b0459fe7e6e0b' '090339ec0aa6faefd5ccc2c6f4ce8e94'
+             '1e36b26bd1ebc670d1bd1d665620abf7' '4f78a7f6d29809585a97daec58c6b050',
+        256: '601ec313775789a5b7a7f504bbf3d228' 'f443e3ca4d62b59aca84e990cacaf5c5'
+             '2b0930daa23de94ce87017ba2d84988d' 'dfc9c58db67aada613c2dd08457941a6',
+    },
+}
+# Block modes take one block per call
+BLOCK_MODES = ('ecb', 'cbc')
+
+
+def new_mode(mode, segment_size, key):
+    if mode == 'cbc':
+        return pyaes.AESModeOfOperationCBC(key, bytes.fromhex(IV))
+    if mode == 'cfb':
+        return pyaes.AESModeOfOperationCFB(key, bytes.fromhex(IV), segment_size)
+    if mode == 'ofb':
+        return pyaes.AESModeOfOperationOFB(key, bytes.fromhex(IV))
+    if mode == 'ctr':
+        return pyaes.AESModeOfOperationCTR(key, pyaes.Counter(int(INITIAL_COUNTER, 16)))
+    return pyaes.AESModesOfOperation[mode](key)
+
+
+def mode_label(mode, segment_size):
+    if mode == 'cfb':
+        return 'cfb%d' % (segment_size * 8)
+    return mode
+
+
+def pieces(data, mode, segment_size):
+    """Split data the way a caller could feed it: blocks for block modes, uneven segments for stream modes"""
+    if mode in BLOCK_MODES:
+        step = [BLOCK_SIZE]
+    elif mode == 'cfb':
+        step = [segment_size, 3 * segment_size, 2 * segment_size]
+    else:
+        step = [1, 7, 16, 5, 33]
+    chunks, offset, index = [], 0, 0
+    while offset < len(data):
+        size = step[index % len(step)]
+        chunks.append(data[offset:offset + size])
+        offset += size
+        index += 1
+    return chunks
+
+
+def run_mode(mode, segment_size, key, data, decrypt, whole):
+    cipher = new_mode(mode, segment_size, key)
+    function = cipher.decrypt if decrypt else cipher.encrypt
+    if whole and mode not in BLOCK_MODES:
+        return bytes(function(data))
+    return b''.join(bytes(function(chunk)) for chunk in pieces(data, mode, segment_size))
+
+
+def verify():
+    """Check every known answer, return the number of failures"""
+    failures = 0
+    plaintext = bytes.fromhex(PLAINTEXT)
+    for key_size, key in sorted(KEYS.items()):
+        key = bytes.fromhex(key)
+        aes = pyaes.AES(key)
+        expected = bytes.fromhex(CIPHERTEXTS[('ecb', None)][key_size])
+        out = bytearray(BLOCK_SIZE)
+        for offset in range(0, len(plaintext), BLOCK_SIZE):
+            block, cipher_block = plaintext[offset:offset + BLOCK_SIZE], expected[offset:offset + BLOCK_SIZE]
+            checks = [('AES.encrypt', bytes(aes.encrypt(block)), cipher_block),
+                      ('AES.decrypt', bytes(aes.decrypt(cipher_block)), block)]
+            aes.encrypt_block_into(block, out)
+            checks.append(('AES.encrypt_block_into', bytes(out), cipher_block))
+            aes.decrypt_block_into(cipher_block, out)
+            checks.append(('AES.decrypt_block_into', bytes(out), block))
+            for label, result, wanted in checks:
+                if result != wanted:
+                    failures += 1
+                    print('FAIL AES-%d %s block %d' % (key_size, label, offset // BLOCK_SIZE))
+
+        for (mode, segment_size), ciphertexts in sorted(CIPHERTEXTS.items(), key=lambda item: str(item[0])):
+            ciphertext = bytes.fromhex(ciphertexts[key_size])
+            message = plaintext[:len(ciphertext)]
+            label = mode_label(mode, segment_size)
+            for whole in (True, False):
+                checks = [('encrypt', run_mode(mode, segment_size, key, message, False, whole), ciphertext),
+                          ('decrypt', run_mode(mode, segment_size, key, ciphertext, True, whole), message)]
+                for operation, result, wanted in checks:
+                    if result != wanted:
+                        failures += 1
+                        print('FAIL AES-%d %s %s%s' % (key_size, label, operation, '' if whole else ' in pieces'))
+    return failures
+
+
+def time_per_call(function, seconds):
+    """Return seconds per call of function, the best of 3 runs of about seconds / 3 each"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(function, number=number)
+        if elapsed >= seconds / 3 / 4:
+            break
+        number *= 4
+    number = max(1, int(number * seconds / 3 / max(elapsed, 1e-9)))
+    return min(timeit.repeat(function, number=number, repeat=3)) / number
+
+
+def benchmark(size, seconds):
+    """Return {name: bytes per second} for the block cipher and every mode"""
+    results = {}
+    data = os.urandom(size)
+    block = data[:BLOCK_SIZE]
+    out = bytearray(BLOCK_SIZE)
+    for key_size in sorted(KEYS):
+        key = os.urandom(key_size // 8)
+        aes = pyaes.AES(key)
+        operations = [
+            ('AES.encrypt', BLOCK_SIZE, lambda: aes.encrypt(block)),
+            ('AES.decrypt', BLOCK_SIZE, lambda: aes.decrypt(block)),
+            ('AES.encrypt_block_into', BLOCK_SIZE, lambda: aes.encrypt_block_into(block, out)),
+            ('AES.decrypt_block_into', BLOCK_SIZE, lambda: aes.decrypt_block_into(block, out)),
+        ]
+        for mode, segment_size in sorted(CIPHERTEXTS, key=str):
+            for decrypt in (False, True):
+                operation = '%s.%s' % (mode_label(mode, segment_size), 'decrypt' if decrypt else 'encrypt')
+                # A fresh mode object per run, as the chat does per message; block modes a block per call
+                function = (lambda mode=mode, segment_size=segment_size, decrypt=decrypt:
+                            run_mode(mode, segment_size, key, data, decrypt, True))
+                operations.append((operation, size, function))
+        for operation, processed, function in operations:
+            name = 'AES-%d %s' % (key_size, operation)
+            results[name] = processed / time_per_call(function, seconds)
+            print('%-34s %10.0f blocks/s %8.3f MB/s' % (name, results[name] / BLOCK_SIZE, results[name] / 1e6))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print every timing relative to the baseline, return the number that got slower than tolerance allows"""
+    slower = 0
+    print('\ncompared to the baseline of %s (%s)' % (baseline.get('date', '?'), baseline.get('machine', '?')))
+    for name, speed in sorted(results.items()):
+        reference = baseline['bytes_per_second'].get(name)
+        if not reference:
+            print('%-34s new' % name)
+            continue
+        ratio = speed / reference
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = '  SLOWER'
+            slower += 1
+        print('%-34s x%.2f%s' % (name, ratio, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=4096, help='bytes per mode encrypt/decrypt run')
+    parser.add_argument('--seconds', type=float, default=0.3, help='time spent on each timing')
+    parser.add_argument('--verify-only', action='store_true', help='only check the known answers')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline to compare against')
+    parser.add_argument('--save-baseline', metavar='PATH', nargs='?', const=BASELINE,
+                        help='write the timings as the new baseline (%(const)s by default)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown flagged, 0.2 for 20%%')
+    parser.add_argument('--strict', action='store_true', help='exit with status 1 if anything got slower')
+    options = parser.parse_args()
+
+    failures = verify()
+    print('known answers: %s' % ('%d FAILED' % failures if failures else 'all %d key sizes and %d modes match' %
+                                 (len(KEYS), len(CIPHERTEXTS))))
+    if failures:
+        sys.exit(1)
+    if options.verify_only:
+        return
+
+    # The block modes take whole blocks
+    size = max(BLOCK_SIZE, options.size // BLOCK_SIZE * BLOCK_SIZE)
+    results = benchmark(size, options.seconds)
+    slower = 0
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as output:
+            json.dump({'date': time.strftime('%Y-%m-%d'), 'python': platform.python_version(),
+                       'machine': ', '.join(filter(None, (platform.machine(), platform.processor(),
+                                                          '%d cores' % (os.cpu_count() or 1)))), 'size': size,
+                       'bytes_per_second': {name: round(speed, 1) for name, speed in sorted(results.items())}},
+                      output, indent=2)
+            output.write('\n')
+        print('\nbaseline saved to %s' % options.save_baseline)
+    elif os.path.exists(options.baseline):
+        with open(options.baseline) as source:
+            slower = compare(results, json.load(source), options.tolerance)
+    if slower and options.strict:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark: time spent in SessionCipher.encrypt and decrypt with and without keystream reservoirs
+
+Encrypts messages of a given size at a chat-like pace, leaving the background
+thread time to refill between them, and reports the time the caller (the Tk
+thread in gui.py) waits per message, compared to generating the keystream
+synchronously. Then decrypts the messages of --senders sessions taking turns,
+as in a busy room. Ciphertexts and plaintexts are checked against pyaes' own
+CTR mode."""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cipher
+import pyaes
+
+KEY = b'This_key_for_demo_purposes_only!'
+
+
+def reference(nonce, counter, plaintext):
+    initial_value = int.from_bytes(nonce + counter.to_bytes(8, 'big'), 'big')
+    return pyaes.AESModeOfOperationCTR(KEY, pyaes.Counter(initial_value)).encrypt(plaintext)
+
+
+def measure(reservoir_size, size, messages, pause):
+    session = cipher.SessionCipher(KEY, reservoir_size=reservoir_size)
+    plaintext = os.urandom(size)
+    waits = []
+    for _ in range(messages):
+        time.sleep(pause)
+        start = time.perf_counter()
+        counter, ciphertext = session.encrypt(plaintext)
+        waits.append(time.perf_counter() - start)
+        assert ciphertext == reference(session.nonce, counter, plaintext)
+    session.close()
+    waits.sort()
+    return waits[len(waits) // 2], waits[-1]
+
+
+def measure_decrypt(reservoir_size, size, messages, pause, senders):
+    session = cipher.SessionCipher(KEY, reservoir_size=reservoir_size)
+    nonces = [os.urandom(cipher.NONCE_SIZE) for _ in range(senders)]
+    counters = [0] * senders
+    plaintext = os.urandom(size)
+    waits = []
+    for index in range(messages):
+        sender = index % senders
+        nonce, counter = nonces[sender], counters[sender]
+        counters[sender] += cipher.counter_blocks(size)
+        ciphertext = reference(nonce, counter, plaintext)
+        time.sleep(pause)
+        start = time.perf_counter()
+        decrypted = session.decrypt(nonce, counter, ciphertext)
+        waits.append(time.perf_counter() - start)
+        assert decrypted == plaintext
+    session.close()
+    waits.sort()
+    return waits[len(waits) // 2], waits[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--pause', type=float, default=0.05, help='seconds between messages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 8192])
+    parser.add_argument('--senders', type=int, nargs='+', default=[1, 20], help='sessions decrypted, taking turns')
+    options = parser.parse_args()
+
+    print('encrypt')
+    print('%-8s %-14s %12s %12s' % ('size', 'keystream', 'median us', 'max us'))
+    for size in options.sizes:
+        for label, reservoir_size in (('synchronous', 0), ('reservoir', cipher.RESERVOIR_SIZE)):
+            median, worst = measure(reservoir_size, size, options.messages, options.pause)
+            print('%-8d %-14s %12.1f %12.1f' % (size, label, median * 1e6, worst * 1e6))
+
+    print('decrypt')
+    print('%-8s %-8s %-14s %12s %12s' % ('size', 'senders', 'keystream', 'median us', 'max us'))
+    for size in options.sizes:
+        for senders in options.senders:
+            for label, reservoir_size in (('synchronous', 0), ('reservoir', cipher.RESERVOIR_SIZE)):
+                median, worst = measure_decrypt(reservoir_size, size, options.messages, options.pause, senders)
+                print('%-8d %-8d %-14s %12.1f %12.1f' % (size, senders, label, median * 1e6, worst * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Benchmark: broadcast messages delivered per second by server.py with 1 to 8 worker processes
+
+For every worker count a server is started in a subprocess and load processes
+connect framed clients to it. Every client sends the same number of broadcasts
+and reads until it has received every other client's messages."""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from framing import FRAMED, FrameDecoder, encode_frame, protocol_line
+
+HOST = '127.0.0.1'
+PORT = 5600
+
+
+async def simulated_client(index, port, messages, expected, ready, go):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    # Welcome banner and its offer line, then switch to frames
+    await reader.readuntil(b"#proto=")
+    await reader.readline()
+    writer.write(protocol_line([FRAMED]) + encode_frame(('#pseudo=user%d' % index).encode()))
+    await reader.readuntil(protocol_line([FRAMED]))
+
+    decoder = FrameDecoder()
+    ready()
+    await go()
+    payload = ('msg;user%d;ALL;%s\n' % (index, 'x' * 64)).encode()
+    for _ in range(messages):
+        writer.write(encode_frame(payload))
+    await writer.drain()
+
+    received = 0
+    while received < expected:
+        data = await reader.read(65536)
+        if not data:
+            break
+        decoder.feed(data)
+        for frame in decoder.frames():
+            if b'> msg;' in bytes(frame):
+                received += 1
+    writer.close()
+    return received
+
+
+def load_process(first, count, clients, port, messages, barrier, results):
+    """Run count simulated clients in one event loop"""
+    async def run():
+        loop = asyncio.get_running_loop()
+        connected = [0]
+        all_connected = asyncio.Event()
+        started = asyncio.Event()
+
+        def ready():
+            connected[0] += 1
+            if connected[0] == count:
+                all_connected.set()
+
+        async def go():
+            await started.wait()
+
+        tasks = [asyncio.ensure_future(simulated_client(first + i, port, messages, (clients - 1) * messages,
+                                                        ready, go)) for i in range(count)]
+        await all_connected.wait()
+        # Every load process is connected, start sending together
+        await loop.run_in_executor(None, barrier.wait)
+        started.set()
+        received = await asyncio.gather(*tasks)
+        results.put(sum(received))
+
+    asyncio.run(run())
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def bench(workers, clients, messages, load_processes, port):
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), '--host', HOST, '--port', str(port),
+                               '--workers', str(workers), '--queue-size', str(clients * messages * 2)],
+                              stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        barrier = multiprocessing.Barrier(load_processes + 1)
+        results = multiprocessing.Queue()
+        per_process = clients // load_processes
+        processes = [multiprocessing.Process(target=load_process,
+                                             args=(i * per_process, per_process, per_process * load_processes,
+                                                   port, messages, barrier, results))
+                     for i in range(load_processes)]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        start = time.perf_counter()
+        delivered = sum(results.get() for _ in processes)
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+        return delivered, elapsed
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=20, help='broadcasts sent by each client')
+    parser.add_argument('--load-processes', type=int, default=4)
+    options = parser.parse_args()
+
+    print('%d cores, %d clients, %d broadcasts each' % (os.cpu_count(), options.clients, options.messages))
+    baseline = None
+    for index, workers in enumerate(options.workers):
+        delivered, elapsed = bench(workers, options.clients, options.messages, options.load_processes,
+                                   PORT + index)
+        rate = delivered / elapsed
+        baseline = baseline or rate
+        print('%d workers: %d messages delivered in %.2fs, %.0f messages/s (x%.2f)' %
+              (workers, delivered, elapsed, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark: bytes on the wire per chat message for the text, framed and v2 protocols
+
+Starts server.ChatServer in process, connects a receiving client for each
+protocol plus senders, and has the senders send broadcast and private
+messages of a given body size. Reports the bytes each receiver read per
+message and how much of it is not the message body."""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+import server
+from framing import FRAMED, encode_frame, protocol_line
+from protocol import V2
+
+SETTLE_TIME = 0.3
+
+
+class Receiver(object):
+    def __init__(self, pseudo, wire):
+        self.pseudo = pseudo
+        self.wire = wire
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self.task = None
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        await self.reader.readuntil(b'#proto=')
+        await self.reader.readline()
+        if self.wire == 'text':
+            self.writer.write(('#pseudo=' + self.pseudo).encode())
+        else:
+            picked = [FRAMED, V2] if self.wire == V2 else [FRAMED]
+            self.writer.write(protocol_line(picked))
+            await self.reader.readuntil(protocol_line(picked))
+            if self.wire == V2:
+                self.writer.write(protocol.encode_message_frame(protocol.PSEUDO, body=self.pseudo.encode()))
+            else:
+                self.writer.write(encode_frame(('#pseudo=' + self.pseudo).encode()))
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                break
+            self.received += len(data)
+
+    async def close(self):
+        self.writer.close()
+        self.task.cancel()
+
+
+async def run(messages, body_size, users):
+    chat_server = server.ChatServer('127.0.0.1', 0, queue_size=1000000)
+    listener = await chat_server.start()
+    port = listener.sockets[0].getsockname()[1]
+
+    # Idle users, so that ids and pseudos are the size they are in a busy room
+    crowd = [Receiver('member%d' % index, V2) for index in range(users)]
+    receivers = [Receiver('reader_' + wire, wire) for wire in ('text', FRAMED, V2)]
+    sender = Receiver('sender', 'text')
+    for client in crowd + receivers + [sender]:
+        await client.connect(port)
+    await asyncio.sleep(SETTLE_TIME)
+    for receiver in receivers:
+        receiver.received = 0
+
+    body = b'x' * body_size + b'\n'
+    for index in range(messages):
+        # Half broadcast, half private to every reader in turn
+        for receiver in receivers:
+            target = 'ALL' if index % 2 == 0 else receiver.pseudo
+            if target == 'ALL' and receiver is not receivers[0]:
+                continue
+            sender.writer.write(b'msg;sender;' + target.encode() + b';' + body)
+            await asyncio.sleep(0.002)
+    await asyncio.sleep(SETTLE_TIME)
+
+    # Every reader got the messages/2 broadcasts and its own messages/2 private ones
+    delivered = messages // 2 + messages // 2
+    results = [(receiver.wire, receiver.received / float(delivered)) for receiver in receivers]
+    for client in crowd + receivers + [sender]:
+        await client.close()
+    await asyncio.sleep(SETTLE_TIME)
+    listener.close()
+    await listener.wait_closed()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--users', type=int, default=200, help='idle users in the room')
+    parser.add_argument('--body-sizes', type=int, nargs='+', default=[8, 32, 128])
+    options = parser.parse_args()
+
+    for body_size in options.body_sizes:
+        results = asyncio.run(run(options.messages, body_size, options.users))
+        text = results[0][1]
+        for wire, per_message in results:
+            print('body %4d bytes  %-7s %6.1f bytes per message, %5.1f overhead, %3.0f%% of text' %
+                  (body_size, wire, per_message, per_message - body_size - 1, 100 * per_message / text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Event bus between the worker processes of a sharded chat server
+
+Every pair of workers is connected by a Unix socket pair created before the
+workers are forked, so each worker holds one socket per peer. Events are
+framed with framing.encode_frame: a one byte event type followed by
+length-prefixed fields.
+
+Writes to a peer are bounded like the queues of client connections: once a
+peer has buffer_limit bytes waiting to be written, chat events for it are
+dropped until it catches up. A worker can't be disconnected the way a slow
+client is, so that happens whatever the slow consumer policy. Events that
+keep the workers' views of pseudos and channels in sync are never dropped,
+they only come with joins, leaves and renames."""
+import asyncio
+import collections
+import socket
+import struct
+
+from framing import FrameDecoder, FrameError, encode_frame
+
+FIELD_HEADER = struct.Struct('>I')
+
+# Events, all fields are bytes. Messages carry their text payload and their protocol v2 payload, either empty
+# if the message isn't for the clients speaking that protocol
+BROADCAST = b'B'    # data, v2 data: for every local connection
+PRIVATE = b'P'      # pseudo, data, v2 data: for the local connection with that pseudo
+CHANNEL = b'C'      # channel, data, v2 data: for the local subscribers of the channel
+PSEUDO = b'N'       # old pseudo, new pseudo, user id, user flags: a connection of the sender changed pseudo, or left
+                    # (new is empty)
+SUBSCRIBE = b'J'    # channel: the sender now has subscribers of channel
+UNSUBSCRIBE = b'L'  # channel: the sender has no subscribers of channel any more
+# Events a slow peer may miss
+DROPPABLE = (BROADCAST, PRIVATE, CHANNEL)
+
+# Bytes waiting to be written to a peer before it is a slow consumer
+BUFFER_LIMIT = 4 * 1024 * 1024
+
+
+def create_mesh(workers):
+    """Create the socket pairs connecting workers, return a list of {peer id: socket} per worker"""
+    mesh = [{} for _ in range(workers)]
+    for first in range(workers):
+        for second in range(first + 1, workers):
+            mesh[first][second], mesh[second][first] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    return mesh
+
+
+def encode_event(event, *fields):
+    return encode_frame(event + b''.join(FIELD_HEADER.pack(len(field)) + field for field in fields))
+
+
+def decode_event(payload):
+    """Return (event, [fields]) from a frame payload"""
+    payload = bytes(payload)
+    event, offset, fields = payload[:1], 1, []
+    while offset < len(payload):
+        size = FIELD_HEADER.unpack_from(payload, offset)[0]
+        offset += FIELD_HEADER.size
+        fields.append(payload[offset:offset + size])
+        offset += size
+    return event, fields
+
+
+class Bus(object):
+    def __init__(self, worker_id, peers, buffer_limit=BUFFER_LIMIT):
+        self.worker_id = worker_id
+        self.peers = peers
+        self.buffer_limit = buffer_limit
+        self.writers = {}
+        self.handler = None
+        # Events dropped per slow peer
+        self.dropped = collections.Counter()
+
+    async def start(self, handler):
+        """Connect to every peer, handler(peer id, event, fields) is called for every event received"""
+        self.handler = handler
+        for peer_id, sock in self.peers.items():
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self.writers[peer_id] = writer
+            asyncio.ensure_future(self.read_loop(peer_id, reader))
+
+    async def read_loop(self, peer_id, reader):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in decoder.frames():
+                    event, fields = decode_event(frame)
+                    self.handler(peer_id, event, fields)
+        except (ConnectionError, FrameError):
+            pass
+
+    def write(self, peer_id, event, data, droppable=True):
+        """Write an encoded event to a peer unless it is droppable and the peer is slow, return False if dropped"""
+        writer = self.writers[peer_id]
+        if droppable and event in DROPPABLE and writer.transport.get_write_buffer_size() >= self.buffer_limit:
+            self.dropped[peer_id] += 1
+            return False
+        writer.write(data)
+        return True
+
+    def send(self, peer_id, event, *fields, droppable=True):
+        return self.write(peer_id, event, encode_event(event, *fields), droppable)
+
+    def publish(self, event, *fields, peers=None, droppable=True):
+        """Send an event to peers, all of them by default, droppable=False for chat events that must not be missed"""
+        data = encode_event(event, *fields)
+        for peer_id in (self.writers if peers is None else peers):
+            self.write(peer_id, event, data, droppable)
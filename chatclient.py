@@ -0,0 +1,629 @@
+"""Chat client without a user interface: protocol negotiation, sending and receiving
+
+A ChatClient tells what it receives to a Listener, whose methods are called on
+the thread running its ClientLoop. One ClientLoop drives any number of
+clients on a single selector, so that a bot or a load generator can run
+thousands of them in one process; client.py runs one of them for gui.GUI."""
+import socket, selectors, queue, sys, collections, base64, threading
+from roster import Roster
+from framing import (CHANNELS, FRAMED, FrameDecoder, FrameError, encode_frame, partial_protocol_line, protocol_line,
+                     split_protocol_line)
+import compression
+import protocol
+from protocol import V2
+
+ENCODING = 'utf-8'
+
+# Bounds of one outbound batch, so that a burst can't delay the next write for long
+MAX_BATCH_MESSAGES = 64
+MAX_BATCH_BYTES = 64 * 1024
+# Protocols whose messages are framed, so that many of them can be written at once
+FRAMED_PROTOCOLS = (FRAMED, V2)
+# v2 flags of the queued chat actions
+MESSAGE_FLAGS = {b'encrypted': protocol.ENCRYPTED, b'ctr': protocol.ENCRYPTED | protocol.SESSION_CTR}
+
+class Listener(object):
+    """What a ChatClient received, every method does nothing unless overridden"""
+
+    def on_chat(self, client, msg):
+        """Chat message [kind, sender, target, body], kind being 'msg', 'plain', 'encrypted' or 'ctr'
+
+        'msg' is a text protocol body, base64 encoded AES-OFB ciphertext if the sender has a key. 'plain' is
+        a v2 plaintext body, never encrypted and already decompressed, 'encrypted' and 'ctr' raw AES-OFB and
+        session cipher ciphertext. Ciphertext is compressed before it is encrypted: once decrypted, bodies go
+        through compression.decompress(), which leaves uncompressed ones as they are.
+
+        body may be a view of the receive buffer, only valid until this returns"""
+
+    def on_notice(self, client, text):
+        """Someone joined or left the chat"""
+
+    def on_roster(self, client, roster):
+        """Users and channels that can be picked as targets changed, roster being client.login_list"""
+
+    def on_received(self, client):
+        """Every message of a read was handed over, client.received_count of them"""
+
+    def on_disconnect(self, client, reason, alert):
+        """Connection lost, alert being the longer explanation"""
+
+
+class ClientLoop(object):
+    """Network loop of any number of chat clients, sleeping in one selector until there is something to do"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # enqueue() and close() of the clients wake the loop up through this socket pair
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        self.clients = set()
+        # Clients whose write interest or state may have changed since the last select
+        self.dirty = set()
+        self.closing = False
+        self.thread = None
+
+    def add(self, client):
+        """Drive a connected client, from the loop thread or before the loop runs"""
+        client.loop = self
+        client.writing = False
+        self.selector.register(client.sock, selectors.EVENT_READ, client)
+        self.clients.add(client)
+        self.dirty.add(client)
+
+    def remove(self, client):
+        self.clients.discard(client)
+        self.dirty.discard(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def touch(self, client):
+        """Have the loop look at client again, from any thread"""
+        self.dirty.add(client)
+        self.wake_up()
+
+    def wake_up(self):
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Pipe full: a wake up is pending anyway
+            pass
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def update(self):
+        """Drop closed clients and wait for write readiness only where there is something to send"""
+        while self.dirty:
+            client = self.dirty.pop()
+            if client not in self.clients:
+                continue
+            if client.closing:
+                self.remove(client)
+                continue
+            # The socket is almost always writable
+            wants_write = client.wants_write()
+            if wants_write != client.writing:
+                events = selectors.EVENT_READ | selectors.EVENT_WRITE if wants_write else selectors.EVENT_READ
+                self.selector.modify(client.sock, events, client)
+                client.writing = wants_write
+
+    def run_once(self, timeout=None):
+        """Wait for and handle one round of events, return False if the selector failed"""
+        self.update()
+        try:
+            ready = self.selector.select(timeout)
+        # if a socket was closed under us, this will raise ValueError/OSError (file descriptor < 0)
+        except (ValueError, OSError):
+            for client in list(self.clients):
+                client.disconnect('Server error', 'Server error has occurred. Exit app')
+            return False
+        for key, events in ready:
+            client = key.data
+            if client is None:
+                self.drain_wakeups()
+                continue
+            try:
+                if events & selectors.EVENT_READ:
+                    client.handle_read()
+                if events & selectors.EVENT_WRITE and not client.closing:
+                    client.flush()
+            except Exception as error:
+                # A malformed message or a failing listener only costs its own client, the others go on
+                self.fail(client, error)
+            self.dirty.add(client)
+        return True
+
+    @staticmethod
+    def fail(client, error):
+        """Disconnect a client that raised error, even if its listener raises again"""
+        try:
+            client.disconnect('Client error', 'Client error has occurred (%r). Exit app' % error)
+        except Exception:
+            client.close()
+
+    def run(self):
+        """Handle client-server communication until every client is closed or the loop is"""
+        while not self.closing:
+            self.update()
+            if not self.clients or not self.run_once():
+                break
+        for client in list(self.clients):
+            self.remove(client)
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+
+    def start(self):
+        """Run the loop on a daemon thread of its own"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.closing = True
+        self.wake_up()
+
+
+class ChatClient(object):
+    def __init__(self, host, port, listener=None, wire_protocols=None):
+        self.host = host
+        self.port = port
+        # Protocols and features this client may pick, None for the best the server offers, () for the text protocol
+        self.wire_protocols = wire_protocols
+        self.sock = None
+        self.listener = listener if listener is not None else Listener()
+        # ClientLoop driving this client, set by ClientLoop.add()
+        self.loop = None
+        self.writing = False
+        self.buffer_size = 1024
+        self.decoder = FrameDecoder()
+
+        # Protocol used to send: None until the welcome banner is read, then 'text', FRAMED or V2
+        self.protocol = None
+        # Whether the server acknowledged framing and now sends frames too
+        self.receiving_frames = False
+        # Number of messages of the last read, told to the listener along with them
+        self.received_count = 0
+        # Beginning of a negotiation line whose end wasn't read yet
+        self.partial_line = b''
+        # Protocols and features offered by the server in its welcome banner
+        self.server_protocols = []
+        # protocol.CAPABILITIES negotiated with the server, as user flags: message bodies may be compressed
+        # and encrypted with the session cipher, for the recipients that can undo it
+        self.capabilities = 0
+
+        self.queue = queue.Queue()
+        self.lock = threading.RLock()
+
+        # Encoded data taken from the queue but not yet fully written to the socket
+        self.pending = collections.deque()
+        # Outbound counters but bytes_received, batch_sizes maps messages per batch to number of batches
+        self.stats = collections.Counter()
+        self.batch_sizes = collections.Counter()
+
+        self.closing = False
+
+        self.login = ''
+        # Deltas are only recorded once a view asks for them, with login_list.start_tracking()
+        self.login_list = Roster(['ALL'], track_deltas=False)
+        # Channels joined, they are listed in login_list too so they can be picked as targets
+        self.channels = set()
+
+        # Protocol v2: own id, and the interned pseudo or channel name of every id announced by the server and
+        # back. login_list is then keyed by these ids
+        self.id = None
+        self.names = {}
+        self.ids = {}
+        # Ids of the users lacking each capability
+        self.users_without = {flag: set() for flag in protocol.CAPABILITIES.values()}
+        self.v2_handlers = {
+            protocol.MSG: self.on_v2_chat,
+            protocol.USER: self.on_v2_user,
+            protocol.LEFT: self.on_v2_left,
+            protocol.CHANNEL: self.on_v2_channel,
+            protocol.ROSTER: self.on_v2_roster,
+        }
+
+        self.target = ''
+
+    def connect_to_server(self):
+        """Connect to server via socket interface, return (is_connected)"""
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.connect((str(self.host), int(self.port)))
+            # Writes must never block the network loop, short writes are resumed when writable again
+            self.sock.setblocking(False)
+        except ConnectionRefusedError:
+            self.sock.close()
+            return False
+        return True
+
+    def wants_write(self):
+        """Whether there is something to send. Nothing is sent before the welcome banner tells which protocol to use"""
+        return bool(self.pending) or (self.protocol is not None and not self.queue.empty())
+
+    def handle_read(self):
+        """Read what the server sent and hand it over to the listener"""
+        with self.lock:
+            try:
+                messages = self.receive()
+            except BlockingIOError:
+                messages = []
+            except (socket.error, FrameError):
+                self.disconnect('Socket error', 'Socket error has occurred. Exit app')
+                return
+
+        if messages is None:
+            self.disconnect('Server closed connection', 'Server has closed the connection. Exit app')
+            return
+
+        if self.receiving_frames and self.protocol == V2:
+            process = self.process_v2_message
+        else:
+            process = self.process_received_data
+        self.received_count = len(messages)
+        for data in messages:
+            process(data)
+        if messages:
+            self.listener.on_received(self)
+
+    def enqueue(self, data):
+        """Queue data for sending and wake the network loop up"""
+        self.queue.put(data)
+        if self.loop is not None:
+            self.loop.touch(self)
+
+    def close(self):
+        """Leave the network loop, which then closes the socket"""
+        self.closing = True
+        if self.loop is not None:
+            self.loop.touch(self)
+
+    def disconnect(self, reason, alert):
+        """Report a connection failure and leave the network loop"""
+        if not self.closing:
+            self.listener.on_disconnect(self, reason, alert)
+        self.close()
+
+    def receive(self):
+        """Read from server, return the list of received messages, None if server closed connection"""
+        if self.receiving_frames:
+            count = self.decoder.recv_into(self.sock)
+            if not count:
+                return None
+            self.stats['bytes_received'] += count
+            return self.received_frames()
+
+        data = self.sock.recv(self.buffer_size)
+        if not data:
+            return None
+        self.stats['bytes_received'] += len(data)
+        return self.receive_text(data)
+
+    def receive_text(self, data):
+        """Handle a chunk of the text protocol, each chunk being one message, and negotiate framing"""
+        if self.protocol is None or self.protocol in FRAMED_PROTOCOLS:
+            # Negotiating: a protocol line split over two reads is only looked at once whole
+            data = self.partial_line + data
+            end = partial_protocol_line(data)
+            data, self.partial_line = data[:end], data[end:]
+            if not data:
+                return []
+        if self.protocol is None:
+            # First chunk is the welcome banner, Python servers append the protocols they offer
+            _, protocols, _ = split_protocol_line(data)
+            self.server_protocols = protocols or []
+            if protocols and self.wire_protocols is not None:
+                protocols = [name for name in protocols if name in self.wire_protocols]
+            if protocols and FRAMED in protocols:
+                picked = [FRAMED, V2] if V2 in protocols else [FRAMED]
+                self.protocol = picked[-1]
+                if V2 in picked:
+                    for name, flag in protocol.CAPABILITIES.items():
+                        if name in protocols:
+                            picked.append(name)
+                            self.capabilities |= flag
+                self.pending.appendleft(protocol_line(picked))
+            else:
+                self.protocol = 'text'
+        elif self.protocol in FRAMED_PROTOCOLS:
+            before, protocols, after = split_protocol_line(data)
+            if protocols is not None:
+                # Server acknowledged framing, whatever follows the acknowledgement is framed
+                if before:
+                    self.process_received_data(before)
+                self.receiving_frames = True
+                self.decoder.feed(after)
+                return self.received_frames()
+        return [data]
+
+    def received_frames(self):
+        """Return the frames decoded so far, v2 ones as views of the receive buffer, valid until the next read"""
+        if self.protocol == V2:
+            return list(self.decoder.frames())
+        return [bytes(frame) for frame in self.decoder.frames()]
+
+    def process_received_data(self, data):
+        """Process received message from server"""
+        if data:
+            message = data.decode(ENCODING)
+            if '#pseudo' not in message and 'joined the chat' not in message:
+                if 'has now pseudo' in message:
+                    message = message.split("pseudo")
+                    message = message[1].strip()
+                    if message not in self.login_list:
+                        self.add_to_login_list(message)
+                        text = message + ' has joined the chat.\n'
+                        self.listener.on_notice(self, text)
+
+                elif 'left the chat' in message:
+                    message = message.split("left")
+                    message = message[0].strip()
+                    text = message + ' has left the chat.\n'
+                    self.listener.on_notice(self, text)
+                    if message in self.login_list:
+                        self.remove_to_login_list(message)
+
+                else:
+                    message = message.split(">")
+                    if len(message) < 2:
+                        # Tail of a message split over two reads, the text protocol has no delimiters
+                        return
+                    msg = message[1].strip().split(";")
+
+                    if '::ffff' in msg:
+                        msg = msg[23:]
+                    if len(msg) < 4:
+                        return
+
+                    if msg[1] not in self.login_list:
+                        self.add_to_login_list(msg[1])
+
+                    if msg[2] == self.login or msg[2] == 'ALL' or msg[2] in self.channels:
+                        self.listener.on_chat(self, msg)
+
+    def process_v2_message(self, data):
+        """Process a message of protocol v2, dispatching on its type"""
+        kind, flags, sender, target, body = protocol.decode_message(data)
+        handler = self.v2_handlers.get(kind)
+        if handler:
+            handler(flags, sender, target, body)
+
+    def on_v2_chat(self, flags, sender, target, body):
+        if target == protocol.EVERYBODY:
+            target = 'ALL'
+        elif target == self.id:
+            target = self.login
+        else:
+            target = self.names.get(target)
+            if target not in self.channels:
+                return
+        if flags & protocol.SESSION_CTR:
+            msg = ['ctr', self.names.get(sender, '?'), target, body]
+        elif flags & protocol.ENCRYPTED:
+            # Raw ciphertext, decrypted straight from the receive buffer
+            msg = ['encrypted', self.names.get(sender, '?'), target, body]
+        else:
+            # Plaintext, whether the receiver has a key or not, compressed if every recipient could decompress it
+            msg = ['plain', self.names.get(sender, '?'), target, compression.decompress(bytes(body))]
+        self.listener.on_chat(self, msg)
+
+    def on_v2_user(self, flags, sender, target, body):
+        if sender == protocol.EVERYBODY or not body:
+            # Not a user anybody can send to
+            return
+        pseudo = sys.intern(str(body, ENCODING))
+        old = self.names.get(sender)
+        if old is not None and old != pseudo:
+            # Renamed, listed again under its new pseudo
+            self.ids.pop(old, None)
+            self.remove_to_login_list(sender)
+        self.names[sender] = pseudo
+        self.ids[pseudo] = sender
+        self.set_user_flags(sender, flags)
+        if pseudo == self.login:
+            self.id = sender
+        if sender not in self.login_list:
+            self.add_to_login_list(sender, pseudo)
+            self.listener.on_notice(self, pseudo + ' has joined the chat.\n')
+
+    def on_v2_roster(self, flags, sender, target, body):
+        for user_id, pseudo, user_flags in protocol.decode_roster(body):
+            pseudo = sys.intern(pseudo.decode(ENCODING))
+            self.names[user_id] = pseudo
+            self.ids[pseudo] = user_id
+            self.set_user_flags(user_id, user_flags)
+            self.add_to_login_list(user_id, pseudo)
+
+    def set_user_flags(self, user_id, flags):
+        for flag, users in self.users_without.items():
+            if flags & flag:
+                users.discard(user_id)
+            else:
+                users.add(user_id)
+
+    def on_v2_left(self, flags, sender, target, body):
+        pseudo = self.names.pop(sender, None)
+        if pseudo is not None:
+            self.ids.pop(pseudo, None)
+            for users in self.users_without.values():
+                users.discard(sender)
+            self.listener.on_notice(self, pseudo + ' has left the chat.\n')
+            self.remove_to_login_list(sender)
+
+    def on_v2_channel(self, flags, sender, target, body):
+        channel = sys.intern(str(body, ENCODING))
+        if channel in self.channels:
+            self.names[sender] = channel
+            self.ids[channel] = sender
+            self.add_to_login_list(sender, channel)
+
+    def recipients_can(self, target, flag):
+        """Whether every recipient of a message to target has a capability, given as a user flag"""
+        if not self.capabilities & flag:
+            return False
+        if target == 'ALL':
+            # Only if every user there has it
+            return not self.users_without[flag]
+        # Channel members aren't known here
+        target_id = self.ids.get(target)
+        return target_id is not None and target not in self.channels and target_id not in self.users_without[flag]
+
+    def compress(self, target, data):
+        """Compress a message body for target if every recipient can decompress it"""
+        if self.recipients_can(target, protocol.CAN_DEFLATE):
+            return compression.compress(data)
+        return data
+
+    def notify_server(self, action, action_type):
+        """Notify server if action is performed by client"""
+        if action_type == "login":
+            self.login = action.decode(ENCODING).split(';')[1]
+            self.enqueue(action)
+        elif action_type == "logout":
+            # Closing the connection is the logout, the server announces it to the others
+            self.close()
+
+    def set_pseudo(self, pseudo):
+        """Log in as pseudo, or change pseudo"""
+        self.notify_server(('login;' + pseudo).encode(ENCODING), 'login')
+
+    def send(self, target, body, kind='msg'):
+        """Send body, bytes or text, to a pseudo, a channel or 'ALL'
+
+        kind is 'msg' for plaintext, compressed for the recipients that can decompress it, 'encrypted' for AES-OFB
+        ciphertext and 'ctr' for session cipher ones, starting with their protocol.encode_ctr_extension()"""
+        if isinstance(body, str):
+            body = body.encode(ENCODING)
+        if kind == 'msg':
+            body = self.compress(target, body)
+        self.enqueue(b';'.join((kind.encode(ENCODING), self.login.encode(ENCODING), target.encode(ENCODING), body)))
+
+    def join_channel(self, name):
+        """Join channel name, return False if the server has no channels"""
+        if CHANNELS not in self.server_protocols:
+            return False
+        channel = '#' + name.lstrip('#')
+        if channel not in self.channels:
+            self.channels.add(channel)
+            if self.protocol != V2:
+                # With v2 it is listed under its id once the server tells it
+                self.add_to_login_list(channel)
+            self.enqueue(('join;' + channel).encode(ENCODING))
+        return True
+
+    def leave_channel(self, name):
+        """Leave channel name, return False if it wasn't joined"""
+        channel = '#' + name.lstrip('#')
+        if channel not in self.channels:
+            return False
+        self.channels.remove(channel)
+        if self.protocol == V2:
+            channel_id = self.ids.pop(channel, None)
+            self.names.pop(channel_id, None)
+            self.remove_to_login_list(channel_id)
+        else:
+            self.remove_to_login_list(channel)
+        self.enqueue(('leave;' + channel).encode(ENCODING))
+        return True
+
+    def encode_message(self, data):
+        """Turn a queued action into the bytes to write on the wire, None if it can't be sent"""
+        if self.protocol == V2:
+            return self.encode_v2_message(data)
+        if data.startswith((b'encrypted;', b'ctr;')):
+            # Raw ciphertext, the text protocol carries it base64 encoded
+            _, login, target, body = data.split(b';', 3)
+            data = b';'.join((b'msg', login, target, base64.b64encode(body)))
+        actions = data.decode(ENCODING).split(';')
+        if actions[0] == "login":
+            data = "#pseudo=" + actions[1]
+            data = data.encode(ENCODING)
+        elif actions[0] in ("join", "leave"):
+            data = ("#" + actions[0] + "=" + actions[1]).encode(ENCODING)
+        if self.protocol == FRAMED:
+            data = encode_frame(data)
+        return data
+
+    def encode_v2_message(self, data):
+        """Turn a queued action into a protocol v2 frame"""
+        action, _, argument = data.partition(b';')
+        if action == b'login':
+            return protocol.encode_message_frame(protocol.PSEUDO, body=argument)
+        if action == b'join':
+            return protocol.encode_message_frame(protocol.JOIN, body=argument)
+        if action == b'leave':
+            return protocol.encode_message_frame(protocol.PART, body=argument)
+        # msg;login;target;body, encrypted;login;target;ciphertext or ctr;login;target;extension+ciphertext
+        _, target, body = argument.split(b';', 2)
+        flags = MESSAGE_FLAGS.get(action, 0)
+        target = target.decode(ENCODING)
+        target_id = protocol.EVERYBODY if target == 'ALL' else self.ids.get(target)
+        if target_id is None:
+            # Nobody the server knows of, it would have been sent to nobody
+            self.stats['unroutable'] += 1
+            return None
+        return protocol.encode_message_frame(protocol.MSG, target=target_id, body=body, flags=flags)
+
+    def fill_batch(self):
+        """Move queued messages to the pending buffers, up to the batch limits"""
+        # The text protocol has no delimiters, each message must reach the server as its own write
+        limit = MAX_BATCH_MESSAGES if self.protocol in FRAMED_PROTOCOLS else 1
+        count = size = 0
+        while count < limit and size < MAX_BATCH_BYTES:
+            try:
+                data = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            data = self.encode_message(data)
+            self.queue.task_done()
+            if data is None:
+                continue
+            self.pending.append(data)
+            count += 1
+            size += len(data)
+        if count:
+            self.stats['batches'] += 1
+            self.stats['messages'] += count
+            self.batch_sizes[count] += 1
+
+    def flush(self):
+        """Write pending data in one scatter write, keeping whatever the socket didn't take"""
+        if not self.pending and self.protocol is not None:
+            self.fill_batch()
+        if not self.pending:
+            return
+        with self.lock:
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(self.pending)
+                else:
+                    sent = self.sock.send(b''.join(self.pending))
+            except BlockingIOError:
+                return
+            except socket.error:
+                self.disconnect('Server error', 'Server error has occurred. Exit app')
+                return
+        self.stats['bytes'] += sent
+
+        # Drop what was written, the rest waits for the next write readiness
+        while self.pending and sent >= len(self.pending[0]):
+            sent -= len(self.pending.popleft())
+        if sent:
+            self.pending[0] = memoryview(self.pending[0])[sent:]
+        if self.pending:
+            self.stats['short_writes'] += 1
+
+    def add_to_login_list(self, user, label=None):
+        if self.login_list.add(user, label):
+            self.listener.on_roster(self, self.login_list)
+
+    def remove_to_login_list(self, user):
+        if self.login_list.remove(user):
+            self.listener.on_roster(self, self.login_list)
+
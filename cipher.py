@@ -0,0 +1,236 @@
+"""Session cipher: AES-CTR with a fresh random nonce for every chat session
+
+Counter blocks are the 8 byte session nonce followed by an 8 byte big-endian
+block counter. The counter of a session only ever moves forward and every
+message starts on a block of its own, so that no keystream is ever used twice
+under a key, unlike with a fixed IV. Receivers decrypt each message on its
+own from the nonce and first counter value it carries
+(protocol.encode_ctr_extension).
+
+Keystream doesn't depend on the message, so it is generated ahead by one
+background thread per session cipher, a KeystreamFiller, into a
+KeystreamReservoir for the session's own messages and one for each session
+received from repeatedly: encrypting and decrypting is then a XOR with
+keystream that is already there, AES only running on the caller's thread
+when a message is bigger than what is ready. The first message of a session
+received from, and short messages of a session without a reservoir, are
+decrypted on the caller's thread, so that a busy room doesn't keep setting
+reservoirs up that are only used once. The background thread pauses while a
+caller generates keystream itself, rather than compete with it for the GIL.
+
+Clients that can decrypt session cipher messages say so by picking CTR on the
+#proto= line, messages being encrypted with the session cipher only when every
+recipient can decrypt them."""
+import collections
+import os
+import struct
+import threading
+
+import pyaes
+
+CTR = 'ctr'
+NONCE_SIZE = 8
+BLOCK_SIZE = 16
+# Keystream kept ready by each reservoir, and generated per lock round trip: a few blocks only, a caller
+# needing keystream right away waits for the round in progress
+RESERVOIR_SIZE = 16 * 1024
+FILL_BLOCKS = 4
+# Sessions received from whose keystream is kept ready, least recently used ones dropped first
+MAX_INCOMING = 8
+# Sessions received from that are remembered, so that a reservoir is only set up for the ones sending again
+MAX_SEEN = 256
+# Messages of at most this many blocks are decrypted on the caller's thread unless their session has a reservoir
+SHORT_BLOCKS = 16
+
+_counter_block = struct.Struct('>8sQ')
+
+
+def counter_blocks(size):
+    """Number of counter blocks covering size bytes"""
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+
+def keystream(aes, nonce, counter, blocks):
+    """Return the keystream of blocks counter blocks of nonce from counter on, aes being a pyaes.AES
+
+    pyaes' CTR mode generates it, starting from the counter block made of nonce and counter: the mode object
+    shares the key schedule of aes and costs next to nothing to set up."""
+    initial_value = int.from_bytes(_counter_block.pack(nonce, counter), 'big')
+    return pyaes.AESModeOfOperationCTR(aes, pyaes.Counter(initial_value)).keystream(blocks)
+
+
+def xor(data, stream):
+    """Return data XORed with the first len(data) bytes of stream"""
+    return pyaes._xor_bytes(data, stream[:len(data)])
+
+
+class KeystreamFiller(object):
+    """Background thread generating keystream ahead for any number of reservoirs, a round of each in turn"""
+    def __init__(self):
+        # Also the lock of the reservoirs filled
+        self.condition = threading.Condition()
+        self.reservoirs = []
+        # Callers generating keystream themselves, which the thread then leaves the GIL to
+        self.waiting = 0
+        self.closed = False
+        self.thread = None
+
+    def add(self, reservoir):
+        with self.condition:
+            self.reservoirs.append(reservoir)
+            if self.thread is None and reservoir.size:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def remove(self, reservoir):
+        with self.condition:
+            if reservoir in self.reservoirs:
+                self.reservoirs.remove(reservoir)
+
+    def keystream(self, aes, nonce, counter, blocks):
+        """Generate keystream on the caller's thread, the background thread pausing meanwhile"""
+        with self.condition:
+            self.waiting += 1
+        try:
+            return keystream(aes, nonce, counter, blocks)
+        finally:
+            with self.condition:
+                self.waiting -= 1
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (self.waiting or
+                                           not any(reservoir.wants_fill() for reservoir in self.reservoirs)):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                reservoirs = [reservoir for reservoir in self.reservoirs if reservoir.wants_fill()]
+            for reservoir in reservoirs:
+                if self.waiting:
+                    break
+                reservoir.fill_once()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.reservoirs = []
+            self.condition.notify()
+
+
+class KeystreamReservoir(object):
+    """Keystream of one session nonce, generated ahead of its use by a KeystreamFiller"""
+    def __init__(self, aes, nonce, filler, counter=0, size=RESERVOIR_SIZE):
+        self.aes = aes
+        self.nonce = bytes(nonce)
+        self.filler = filler
+        self.size = size
+        # ready holds the keystream of counter blocks start to end
+        self.start = self.end = counter
+        self.ready = bytearray()
+        self.condition = filler.condition
+        filler.add(self)
+
+    def wants_fill(self):
+        """Whether keystream is missing, with the filler's lock held"""
+        return len(self.ready) < self.size
+
+    def fill_once(self):
+        with self.condition:
+            end = self.end
+        # Generated without the lock, so that take() never waits for AES
+        stream = keystream(self.aes, self.nonce, end, FILL_BLOCKS)
+        with self.condition:
+            # Unless take() moved elsewhere meanwhile
+            if self.end == end:
+                self.ready += stream
+                self.end += FILL_BLOCKS
+
+    def take(self, counter, blocks):
+        """Return the keystream of blocks counter blocks from counter on, dropping what comes before"""
+        with self.condition:
+            if not self.start <= counter <= self.end:
+                # Not ahead of what is ready: restart from there
+                del self.ready[:]
+                self.start = self.end = counter
+            del self.ready[:(counter - self.start) * BLOCK_SIZE]
+            ready = min(blocks, self.end - counter)
+            stream = self.ready[:ready * BLOCK_SIZE]
+            del self.ready[:ready * BLOCK_SIZE]
+            self.start = counter + blocks
+            self.end = max(self.end, self.start)
+            self.condition.notify()
+        if ready < blocks:
+            # Bigger than what was ready
+            stream += self.filler.keystream(self.aes, self.nonce, counter + ready, blocks - ready)
+        return stream
+
+    def close(self):
+        self.filler.remove(self)
+
+
+class SessionCipher(object):
+    """AES-CTR session; with a reservoir_size of 0 no keystream is generated ahead"""
+    def __init__(self, key, nonce=None, reservoir_size=RESERVOIR_SIZE):
+        self.key = key
+        self.nonce = os.urandom(NONCE_SIZE) if nonce is None else nonce
+        # Next unused counter block
+        self.counter = 0
+        self.lock = threading.RLock()
+        self.aes = pyaes.AES(key)
+        self.reservoir_size = reservoir_size
+        # One thread generating the keystream of this session, and of the sessions received from by nonce
+        self.filler = KeystreamFiller()
+        self.outgoing = KeystreamReservoir(self.aes, self.nonce, self.filler, size=reservoir_size)
+        self.incoming = collections.OrderedDict()
+        # Nonces received from without a reservoir, least recently used ones forgotten first
+        self.seen = collections.OrderedDict()
+
+    def reserve(self, size):
+        """Take the counter blocks of a size bytes message, return the first one"""
+        with self.lock:
+            counter = self.counter
+            self.counter += counter_blocks(size)
+            return counter
+
+    def encrypt(self, plaintext):
+        """Return (counter, ciphertext), counter being the first counter block used"""
+        blocks = counter_blocks(len(plaintext))
+        with self.lock:
+            # Taken in counter order, as the reservoir generates it
+            counter = self.reserve(len(plaintext))
+            stream = self.outgoing.take(counter, blocks)
+        return counter, xor(plaintext, stream)
+
+    def decrypt(self, nonce, counter, ciphertext):
+        """Decrypt a message of any session encrypted with this key"""
+        nonce = bytes(nonce)
+        blocks = counter_blocks(len(ciphertext))
+        with self.lock:
+            reservoir = self.incoming.get(nonce)
+            if reservoir is not None:
+                self.incoming.move_to_end(nonce)
+            elif nonce in self.seen and blocks > SHORT_BLOCKS and self.reservoir_size:
+                # Sending again, and more than is quick to decrypt here: its next messages are prefetched
+                del self.seen[nonce]
+                reservoir = KeystreamReservoir(self.aes, nonce, self.filler, counter, self.reservoir_size)
+                self.incoming[nonce] = reservoir
+                if len(self.incoming) > MAX_INCOMING:
+                    self.incoming.popitem(last=False)[1].close()
+            else:
+                self.seen[nonce] = True
+                self.seen.move_to_end(nonce)
+                if len(self.seen) > MAX_SEEN:
+                    self.seen.popitem(last=False)
+        if reservoir is None:
+            return xor(ciphertext, self.filler.keystream(self.aes, nonce, counter, blocks))
+        return xor(ciphertext, reservoir.take(counter, blocks))
+
+    def close(self):
+        """Stop generating keystream"""
+        with self.lock:
+            self.filler.close()
+            self.incoming.clear()
+            self.seen.clear()
@@ -0,0 +1,68 @@
+"""Compression of chat message bodies with a dictionary shared by every client
+
+Chat lines are too short for zlib to find much to reuse within one of them,
+so every body is deflated against a preset dictionary of the words and
+phrases chat traffic is made of. A compressed body starts with MARKER, a byte
+that never starts UTF-8 text, so that it is recognised wherever it ends up,
+in particular after decryption. Compression is applied to the body before it
+is encrypted and undone after it is decrypted.
+
+Clients that can decompress say so by picking DEFLATE on the #proto= line,
+and the server tells everybody which users can in protocol v2 announcements.
+A body is only compressed when every recipient can decompress it."""
+import zlib
+
+DEFLATE = 'deflate'
+MARKER = b'\xff'
+LEVEL = 9
+# Raw deflate streams, no zlib header nor checksum: every byte counts on short messages. A 2 KB window
+# holds the dictionary and a chat line, and with a small memory level setting a compressor up costs a
+# few microseconds instead of tens
+WINDOW_BITS = -11
+MEM_LEVEL = 4
+# Largest decompressed body: anything bigger is left compressed, so that a small body can't expand to
+# gigabytes in every recipient's client
+MAX_BODY = 1024 * 1024
+
+# Most frequent strings last, they are the cheapest to refer to
+DICTIONARY = (
+    b'please could you would should about there their they were what when where which with your '
+    b'have from this that will just like know think really good great thanks thank you sorry '
+    b'tomorrow today tonight morning evening weekend meeting working work home later soon '
+    b'http://https://www..com .org .net github.com '
+    b'haha lol ok okay yes no not sure maybe right now here see you later '
+    b'how are you doing? what do you think? are you there? did you see '
+    b'I am I\'m I will I\'ll I think I don\'t know do you want to can you let me know '
+    b'hello hi hey everyone all guys :) :( :D ;) ! ? . , '
+    b'the and to of a in is it for on that you I '
+)
+
+
+def compress(data):
+    """Return data compressed if that makes it smaller, data itself otherwise"""
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + len(MARKER) >= len(data):
+        return data
+    return MARKER + compressed
+
+
+def is_compressed(data):
+    return data[:1] == MARKER
+
+
+def decompress(data):
+    """Return data decompressed if it was compressed, data itself otherwise or if it doesn't decompress
+
+    Bodies that would decompress to more than MAX_BODY bytes don't."""
+    if not is_compressed(data):
+        return data
+    decompressor = zlib.decompressobj(WINDOW_BITS, zdict=DICTIONARY)
+    try:
+        decompressed = decompressor.decompress(bytes(data[len(MARKER):]), MAX_BODY)
+    except zlib.error:
+        return data
+    # Input left over, or a stream that doesn't end within the limit
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return data
+    return decompressed
@@ -0,0 +1,132 @@
+"""Length-prefixed framing shared by the chat client and the Python server
+
+A frame is a 4 byte big-endian payload length followed by the payload, so one
+read may carry many messages and a long message may span many reads.
+
+Framing is negotiated over the text protocol, which legacy peers keep using:
+the Python server appends an offer line to its welcome banner, a client that
+wants frames answers with the protocol it picked, the server acknowledges it
+with the same line and from then on both directions are framed.
+"""
+import struct
+
+HEADER = struct.Struct('>I')
+RECV_BUFFER_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Negotiation line: #proto=<name>[,<name>...]\r\n
+PROTOCOL_MARKER = b'#proto='
+FRAMED = 'framed'
+# Not a protocol but a server feature, offered on the same line: #join= and #leave= commands
+CHANNELS = 'channels'
+
+
+class FrameError(ValueError):
+    """Raised when a peer announces a frame larger than MAX_FRAME_SIZE"""
+
+
+def encode_frame(payload):
+    """Return payload prefixed with its length"""
+    return HEADER.pack(len(payload)) + payload
+
+
+def protocol_line(protocols):
+    """Build the negotiation line offering or picking protocols"""
+    return PROTOCOL_MARKER + ','.join(protocols).encode('ascii') + b'\r\n'
+
+
+def split_protocol_line(data):
+    """Find a negotiation line in text data, return (before, protocols, after)
+
+    protocols is None, and data is returned whole as before, if data holds no
+    complete negotiation line."""
+    start = data.find(PROTOCOL_MARKER)
+    if start == -1:
+        return data, None, b''
+    end = data.find(b'\n', start)
+    if end == -1:
+        return data, None, b''
+    names = bytes(data[start + len(PROTOCOL_MARKER):end]).strip().decode('ascii', 'replace')
+    protocols = [name for name in names.split(',') if name]
+    return data[:start], protocols, data[end + 1:]
+
+
+def partial_protocol_line(data):
+    """Return the offset of the beginning of a negotiation line that data ends with, len(data) if it doesn't
+
+    A line split over two reads is then held back until the rest of it comes."""
+    start = data.rfind(PROTOCOL_MARKER)
+    if start != -1 and data.find(b'\n', start) == -1:
+        return start
+    for size in range(min(len(PROTOCOL_MARKER) - 1, len(data)), 0, -1):
+        if data.endswith(PROTOCOL_MARKER[:size]):
+            return len(data) - size
+    return len(data)
+
+
+class FrameDecoder(object):
+    """Incremental frame decoder over a reusable receive buffer
+
+    Data is read straight into a preallocated bytearray with recv_into (or
+    appended with feed) and complete frames are handed out as memoryview
+    slices of that buffer. A frame view is only valid until the next call to
+    recv_into or feed, copy it with bytes() to keep it longer."""
+
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.max_frame_size = max_frame_size
+        # Received but not yet decoded data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, size):
+        """Make sure size more bytes fit after the pending data"""
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= size:
+            return
+        if pending + size <= len(self.buffer):
+            # Move the pending data to the front, this never resizes the buffer
+            self.buffer[:pending] = self.view[self.start:self.end]
+        else:
+            buffer = bytearray(max(pending + size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
+
+    def _wanted(self):
+        """Free space to ask for, enough for the whole frame being received"""
+        pending = self.end - self.start
+        if pending >= HEADER.size:
+            size = HEADER.unpack_from(self.buffer, self.start)[0] + HEADER.size
+            if size > pending:
+                return max(size - pending, RECV_BUFFER_SIZE // 4)
+        return RECV_BUFFER_SIZE // 4
+
+    def recv_into(self, sock):
+        """Read from sock in one recv_into call, return the number of bytes read (0 on EOF)"""
+        self._make_room(self._wanted())
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """Append data obtained by other means, e.g. an asyncio stream"""
+        self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """Yield the payload of every complete frame received so far"""
+        while self.end - self.start >= HEADER.size:
+            size = HEADER.unpack_from(self.buffer, self.start)[0]
+            if size > self.max_frame_size:
+                raise FrameError('frame of %d bytes exceeds the %d bytes limit' % (size, self.max_frame_size))
+            if self.end - self.start - HEADER.size < size:
+                break
+            start = self.start + HEADER.size
+            self.start = start + size
+            yield self.view[start:start + size]
@@ -1,15 +1,51 @@
 import base64
+import collections
 import tkinter as tk
 import threading
 from tkinter import scrolledtext
 from tkinter import messagebox
 import pyaes
+import batch
+import cipher
+from chatclient import Listener
+import compression
+import protocol
+from history import ScrollbackLog
 
 ENCODING = 'utf-8'
 RSA_KEY = None
+# Milliseconds between two refreshes of the chat window with what the network thread received
+REFRESH_INTERVAL = 25
+# Lines kept in the chat window, older ones are moved to an on-disk log and paged back on demand
+SCROLLBACK_LINES = 2000
+# Messages received at once from which their decryption is handed to worker processes
+BATCH_DECRYPT_MIN = 32
 
 
-class GUI(threading.Thread):
+class PendingMessage(object):
+    """Chat message of the inbox being decrypted by a batch.BatchDecryptor, shown once it is"""
+
+    def __init__(self, msg):
+        self.msg = msg
+        # Set once submitted to the batch decryptor
+        self.future = None
+        self.index = None
+
+    def job(self):
+        return self.msg[0], self.msg[3]
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def text(self, window):
+        plaintexts = None if self.future.exception() else self.future.result()
+        if plaintexts is None or plaintexts[self.index] is None:
+            # Decrypted here then, failing the way it would have without workers
+            return window.beautify_message(self.msg)
+        return window.beautify_message(['decrypted'] + self.msg[1:3] + [plaintexts[self.index]])
+
+
+class GUI(threading.Thread, Listener):
     def __init__(self, client, args=None):
         super().__init__(daemon=False, target=self.run, args=args)
         self.args = args
@@ -18,10 +54,23 @@ class GUI(threading.Thread):
         self.login_window = None
         self.main_window = None
 
+        # Filled by the network thread, drained by the Tk thread every REFRESH_INTERVAL
+        self.inbox = collections.deque()
+        # Alerts of the network thread, shown by the Tk thread after the messages received before them
+        self.alerts = collections.deque()
+        self.decryptor = None
+        # Chat messages of the burst being received, decrypted by worker processes once it is
+        self.deferred = []
+        self.login_list = None
+        # The login list is shown by applying its changes one row at a time
+        client.login_list.start_tracking()
+
         # RSA_KEY
         if self.args and len(self.args) > 1:
             global RSA_KEY
             RSA_KEY = self.args[1].encode(ENCODING)
+        # AES-CTR with a nonce of its own for this session, for recipients that can decrypt it
+        self.session = cipher.SessionCipher(RSA_KEY) if RSA_KEY else None
 
     def run(self):
         self.login_window = LoginWindow(self, self.font, self.args)
@@ -34,29 +83,82 @@ class GUI(threading.Thread):
 
     @staticmethod
     def display_alert(message):
-        """Display alert box"""
+        """Display alert box, must be called from the Tk thread"""
         messagebox.showinfo('Error', message)
 
     def update_login_list(self, active_users):
-        """Update login list in main window with list of users"""
-        self.main_window.update_login_list(active_users)
+        """Update login list in main window with the changes of the active users roster, from any thread"""
+        self.login_list = active_users
 
     def display_message(self, message):
-        """Display message in ChatWindow"""
-        self.main_window.display_message(message)
+        """Display message in ChatWindow, from any thread"""
+        self.inbox.append(message)
 
     def beautify_message(self, message):
         """Beautify message to display in ChatWindow"""
         return self.main_window.beautify_message(message)
 
+    def batch_decryptor(self):
+        """Worker processes decrypting bursts of messages, None without a key or another core to decrypt on"""
+        if not RSA_KEY or batch.WORKERS < 2:
+            return None
+        if self.decryptor is None:
+            self.decryptor = batch.BatchDecryptor(RSA_KEY)
+        return self.decryptor
+
+    def on_chat(self, client, msg):
+        if client.received_count >= BATCH_DECRYPT_MIN and msg[0] in batch.KINDS and self.batch_decryptor():
+            # Left to the batch decryptor, copied out of the receive buffer
+            pending = PendingMessage(msg[:3] + [bytes(msg[3]) if isinstance(msg[3], memoryview) else msg[3]])
+            self.deferred.append(pending)
+            self.display_message(pending)
+        else:
+            self.display_message(self.beautify_message(msg))
+
+    def on_notice(self, client, text):
+        self.display_message(text)
+
+    def on_roster(self, client, roster):
+        self.update_login_list(roster)
+
+    def on_received(self, client):
+        """Hand the chat messages of a burst over to the batch decryptor"""
+        if self.deferred:
+            for pending, (future, index) in zip(self.deferred,
+                                                self.decryptor.submit([p.job() for p in self.deferred])):
+                pending.index = index
+                pending.future = future
+            self.deferred = []
+
+    def on_disconnect(self, client, reason, alert):
+        print(reason)
+        # Called on the network thread, shown by the next refresh
+        self.alerts.append(alert)
+
     def send_message(self, message):
         """Enqueue message in client's queue"""
-        self.client.queue.put(message)
+        self.client.enqueue(message)
+
+    def compress(self, target, data):
+        """Compress a message body if everybody it is for can decompress it"""
+        return self.client.compress(target, data)
+
+    def use_session_cipher(self, target):
+        """Whether everybody a message is for can decrypt the session cipher"""
+        return self.client.recipients_can(target, protocol.CAN_CTR)
 
     def set_target(self, target):
-        """Set target for messages"""
+        """Set target for messages, a login or a joined channel"""
         self.client.target = target
 
+    def join_channel(self, name):
+        """Join a channel, return False if the server doesn't support channels"""
+        return self.client.join_channel(name)
+
+    def leave_channel(self, name):
+        """Leave a channel, return False if it wasn't joined"""
+        return self.client.leave_channel(name)
+
     def notify_server(self, message, action):
         """Notify server after action was performed"""
         data = action + ";" + message
@@ -120,9 +222,15 @@ class LoginWindow(Window):
 
 
 class ChatWindow(Window):
-    def __init__(self, gui, font):
+    def __init__(self, gui, font, scrollback_lines=SCROLLBACK_LINES, history_path=None):
         super().__init__("Python Chat", font)
         self.gui = gui
+        self.scrollback_lines = scrollback_lines
+        # Everything shown, of which the window holds chunks first to last, last excluded: window_lines lines
+        self.history = ScrollbackLog(history_path)
+        self.first = self.last = 0
+        self.window_lines = 0
+        self.paging = False
         self.messages_list = None
         self.logins_list = None
         self.entry = None
@@ -133,6 +241,7 @@ class ChatWindow(Window):
         self.login = self.gui.login_window.login
 
         self.build_window()
+        self.root.after(REFRESH_INTERVAL, self.refresh)
 
     def build_window(self):
         """Build chat window, set widgets positioning and event bindings"""
@@ -171,8 +280,9 @@ class ChatWindow(Window):
 
         # ScrolledText widget for displaying messages
         self.messages_list = scrolledtext.ScrolledText(frame00, wrap='word', font=self.font)
-        self.messages_list.insert(tk.END, 'Welcome to Python Chat\n')
         self.messages_list.configure(state='disabled')
+        self.display_message('Welcome to Python Chat\n')
+        self.messages_list.configure(yscrollcommand=self.messages_scrolled_event)
 
         # Listbox widget for displaying active users and selecting them
         self.logins_list = tk.Listbox(frame01, selectmode=tk.SINGLE, font=self.font,
@@ -206,6 +316,11 @@ class ChatWindow(Window):
         """Handle chat window actions"""
         self.root.mainloop()
         self.root.destroy()
+        self.history.close()
+        if self.gui.session:
+            self.gui.session.close()
+        if self.gui.decryptor:
+            self.gui.decryptor.close()
 
     def selected_login_event(self, event):
         """Set as target currently selected login on login list"""
@@ -217,18 +332,27 @@ class ChatWindow(Window):
         """Send message from entry field to target"""
         global message
         text = self.entry.get(1.0, tk.END)
+        if text.startswith(('/join ', '/leave ')):
+            self.channel_command(text)
+            return 'break'
         if text != '\n':
-            if RSA_KEY:
+            # Compressed before it is encrypted, ciphertext doesn't compress
+            body = self.gui.compress(self.target, (text[:-1] if RSA_KEY else text).encode(ENCODING))
+            # Echoed as is, rather than decrypted again
+            plaintext = body
+            if RSA_KEY and self.gui.use_session_cipher(self.target):
+                # Encrypt with keystream never used before, whose position goes along with the message
+                counter, body = self.gui.session.encrypt(body)
+                message = (bytes('ctr;' + self.login + ';' + self.target + ';', ENCODING) +
+                           protocol.encode_ctr_extension(self.gui.session.nonce, counter) + body)
+            elif RSA_KEY:
                 # Encrypt!
                 aes = pyaes.AESModeOfOperationOFB(RSA_KEY)
-                # Message encrypt in bytes
-                msg = aes.encrypt(text[:-1])
-                # Base64 encode message to send to server
-                my_msg = base64.b64encode(msg)
-                message = bytes('msg;' + self.login + ';' + self.target + ';', ENCODING) + my_msg
+                # Message encrypt in bytes, sent raw if the protocol allows it and base64 encoded otherwise
+                body = aes.encrypt(body)
+                message = bytes('encrypted;' + self.login + ';' + self.target + ';', ENCODING) + body
             else:
-                message = 'msg;' + self.login + ';' + self.target + ';' + text
-                message = message.encode(ENCODING)
+                message = bytes('msg;' + self.login + ';' + self.target + ';', ENCODING) + body
 
             self.gui.send_message(message)
             self.entry.mark_set(tk.INSERT, 1.0)
@@ -237,18 +361,26 @@ class ChatWindow(Window):
         else:
             messagebox.showinfo('Warning', 'You must enter non-empty message')
 
-        with self.lock:
-            self.messages_list.configure(state='normal')
-            if text != '\n':
-                if self.isBytes(message):
-                    text = self.beautify_message(message)
-                else:
-                    text = self.beautify_message(message.split(';'))
-                self.messages_list.insert(tk.END, text)
-            self.messages_list.configure(state='disabled')
-            self.messages_list.see(tk.END)
+        if text != '\n':
+            text = self.beautify_message(['decrypted', self.login, self.target, plaintext])
+            # Through the inbox, so that it is shown after the messages received before it
+            self.gui.display_message(text)
         return 'break'
 
+    def channel_command(self, text):
+        """Handle '/join <channel>' and '/leave <channel>' typed in the entry field"""
+        words = text.split()
+        if len(words) != 2:
+            messagebox.showinfo('Warning', 'Usage: /join <channel> or /leave <channel>')
+            return
+        command, name = words
+        if command == '/join':
+            if not self.gui.join_channel(name):
+                messagebox.showinfo('Warning', 'This server has no channels')
+        elif not self.gui.leave_channel(name):
+            messagebox.showinfo('Warning', 'You are not in channel ' + name)
+        self.entry.delete(1.0, tk.END)
+
     def exit_event(self, event):
         """Send logout message and quit app when "Exit" pressed"""
         self.gui.notify_server(self.login, 'logout')
@@ -258,40 +390,208 @@ class ChatWindow(Window):
         """Exit window when 'x' button is pressed"""
         self.exit_event(None)
 
+    def refresh(self):
+        """Show everything the network thread received since last refresh, then schedule the next one"""
+        try:
+            self.show_received()
+        finally:
+            # Whatever happened, or the window would never be updated again
+            self.root.after(REFRESH_INTERVAL, self.refresh)
+
+    def show_received(self):
+        """Show the messages of the inbox that are ready, in order, apply the roster changes and show the alerts"""
+        inbox = self.gui.inbox
+        if inbox:
+            messages = []
+            while inbox:
+                message = inbox[0]
+                # Shown in order: nothing after a message that is still being decrypted
+                if isinstance(message, PendingMessage) and not message.done():
+                    break
+                # Taken out first, so that a message that can't be shown isn't tried again and again
+                inbox.popleft()
+                if isinstance(message, PendingMessage):
+                    message = message.text(self)
+                messages.append(message)
+            if messages:
+                self.display_message(''.join(messages))
+
+        active_users = self.gui.login_list
+        if active_users is not None:
+            deltas = active_users.take_deltas()
+            if deltas:
+                self.update_login_list(deltas)
+
+        alerts = self.gui.alerts
+        while alerts:
+            self.gui.display_alert(alerts.popleft())
+
     def display_message(self, message):
-        """Display message in ScrolledText widget"""
+        """Display message in ScrolledText widget, must be called from the Tk thread"""
+        if not message.endswith('\n'):
+            # Chunks are whole lines, so that they can be dropped and read back as they were
+            message += '\n'
+        line_count = message.count('\n')
         with self.lock:
+            at_end = self.last == len(self.history)
+            self.history.append(message, line_count)
+            if not at_end:
+                # The newest lines were dropped for older ones the user paged back to: read back when scrolling down
+                return
+            # Only follow new messages if the user hasn't scrolled up to read older ones
+            following = self.messages_list.yview()[1] >= 1.0
+            if not following and self.window_lines + line_count > self.scrollback_lines:
+                # Left in the log rather than growing the window, or evicting the lines read
+                return
             self.messages_list.configure(state='normal')
             self.messages_list.insert(tk.END, message)
+            self.last += 1
+            self.window_lines += line_count
+            if following and self.window_lines > self.scrollback_lines:
+                # A tenth of the limit more than needed, so that this happens once in a while only
+                self.drop_older(self.scrollback_lines - self.page_lines(), 1)
             self.messages_list.configure(state='disabled')
-            self.messages_list.see(tk.END)
+            if following:
+                self.messages_list.see(tk.END)
+
+    def page_lines(self):
+        """Number of lines read back from the log at once"""
+        return max(1, self.scrollback_lines // 10)
+
+    def drop_older(self, limit, keep):
+        """Drop the oldest chunks of the window down to at most limit lines, return how many lines were removed
+
+        They are in the log already. The window never drops below keep lines, those from the one the user
+        reads on. The widget must be in the 'normal' state."""
+        first, lines = self.first, self.window_lines
+        while lines > limit and lines - self.history.line_counts[first] >= keep:
+            lines -= self.history.line_counts[first]
+            first += 1
+        dropped = self.window_lines - lines
+        if dropped:
+            self.messages_list.delete('1.0', '%d.0' % (dropped + 1))
+            self.first, self.window_lines = first, lines
+        return dropped
+
+    def drop_newer(self, limit, keep):
+        """Drop the newest chunks of the window down to at most limit lines, never below keep lines
+
+        The widget must be in the 'normal' state."""
+        last, lines = self.last, self.window_lines
+        while lines > limit and lines - self.history.line_counts[last - 1] >= keep:
+            last -= 1
+            lines -= self.history.line_counts[last]
+        if lines < self.window_lines:
+            self.messages_list.delete('%d.0' % (lines + 1), tk.END)
+            self.last, self.window_lines = last, lines
+
+    def messages_scrolled_event(self, first, last):
+        """Update scrollbar and read the log back when the user reaches either end of the messages"""
+        self.messages_list.vbar.set(first, last)
+        if self.paging:
+            return
+        if float(first) <= 0.0 and self.first > 0:
+            self.paging = True
+            self.root.after_idle(self.load_older_page)
+        elif float(last) >= 1.0 and self.last < len(self.history):
+            self.paging = True
+            self.root.after_idle(self.load_newer_page)
+
+    def load_older_page(self):
+        """Insert the chunks before the window above it, dropping as many lines at the bottom
+
+        The window holds at most the scrollback limit whichever way the user scrolls, the view staying where it
+        was."""
+        with self.lock:
+            start, line_count = self.first, 0
+            while start > 0 and line_count < self.page_lines():
+                start -= 1
+                line_count += self.history.line_counts[start]
+            if start < self.first:
+                text, line_count = self.history.read(start, self.first)
+                self.messages_list.configure(state='normal')
+                self.messages_list.insert('1.0', text)
+                self.first = start
+                self.window_lines += line_count
+                # The page in view is above the lines dropped
+                self.drop_newer(self.scrollback_lines, line_count + self.page_lines())
+                self.messages_list.configure(state='disabled')
+                self.messages_list.yview('%d.0' % (line_count + 1))
+        self.paging = False
+
+    def load_newer_page(self):
+        """Append the chunks after the window below it, dropping as many lines at the top"""
+        with self.lock:
+            end, line_count = self.last, 0
+            while end < len(self.history) and line_count < self.page_lines():
+                line_count += self.history.line_counts[end]
+                end += 1
+            if end > self.last:
+                text, line_count = self.history.read(self.last, end)
+                # First line shown, kept in view when the lines above it are dropped
+                top = int(self.messages_list.index('@0,0').split('.')[0])
+                self.messages_list.configure(state='normal')
+                self.messages_list.insert(tk.END, text)
+                self.last = end
+                self.window_lines += line_count
+                dropped = self.drop_older(self.scrollback_lines, self.window_lines - top + 1)
+                self.messages_list.configure(state='disabled')
+                self.messages_list.yview('%d.0' % (top - dropped))
+        self.paging = False
+
+    def update_login_list(self, deltas):
+        """Apply roster changes to the listbox one row at a time"""
+        for action, position, user in deltas:
+            if action == 'insert':
+                self.logins_list.insert(position, user)
+            else:
+                self.logins_list.delete(position)
 
-    def update_login_list(self, active_users):
-        """Update listbox with list of active users"""
-        self.logins_list.delete(0, tk.END)
-        for user in active_users:
-            self.logins_list.insert(tk.END, user)
-        self.logins_list.select_set(0)
-        self.target = self.logins_list.get(self.logins_list.curselection())
+        # Selection moves along with the rows, it is only lost if the selected user left
+        if not self.logins_list.curselection():
+            self.logins_list.select_set(0)
+            self.target = self.logins_list.get(0)
 
     def beautify_message(self, msg):
         text = msg
         if len(msg) > 3:
             if self.isBytes(msg):
-                msg = msg.decode(ENCODING).split(';')
+                # Body stays in bytes, it may be compressed
+                msg = msg.split(b';', 3)
+                msg[:3] = [field.decode(ENCODING) for field in msg[:3]]
             text = msg[1] + ' >> [' + msg[2] + '] '
 
+            body = msg[3]
+            # Raw ciphertext rather than base64 encoded one
+            raw = msg[0] in ('encrypted', 'ctr')
             # If message encrypted
-            if RSA_KEY:
-                aes = pyaes.AESModeOfOperationOFB(RSA_KEY)
-                #base64 decode
-                decoded_msg = base64.b64decode(msg[3])
-                # Decrypt!
-                decryptedMsg = aes.decrypt(decoded_msg).decode(ENCODING)
-
-                text += decryptedMsg
-            else:
-                text += msg[3]
+            try:
+                if msg[0] == 'decrypted':
+                    # By the batch decryptor already
+                    pass
+                elif msg[0] == 'plain':
+                    # Sent without a key over v2, nothing to decrypt
+                    pass
+                elif RSA_KEY and msg[0] == 'ctr':
+                    nonce, counter, ciphertext = protocol.decode_ctr_extension(body)
+                    body = self.gui.session.decrypt(nonce, counter, ciphertext)
+                elif RSA_KEY:
+                    aes = pyaes.AESModeOfOperationOFB(RSA_KEY)
+                    #base64 decode
+                    decoded_msg = body if raw else base64.b64decode(body)
+                    # Decrypt!
+                    body = aes.decrypt(decoded_msg)
+                elif raw:
+                    # Can't be decrypted, shown the way the text protocol shows it
+                    body = base64.b64encode(body)
+            except ValueError:
+                # Not what its kind says, e.g. a text protocol message from a sender without a key
+                body = '[message could not be decrypted]'
+
+            if self.isBytes(body):
+                # Decompressed once decrypted
+                body = compression.decompress(body).decode(ENCODING, 'replace')
+            text += body
 
             # If message received
             # if (msg[1] != self.login):
@@ -0,0 +1,45 @@
+"""Append-only on-disk log of the chat lines shown in the chat window"""
+import array
+import tempfile
+
+ENCODING = 'utf-8'
+
+
+class ScrollbackLog(object):
+    """Chat history of the session, of which the window only holds a range of chunks
+
+    Lines are written in chunks, one per batch of messages shown, and only the
+    offset and line count of every chunk is kept in memory. The chunks around
+    the one the user reads are read back as they scroll."""
+
+    def __init__(self, path=None):
+        if path is None:
+            # Session history only, the file is deleted when closed
+            self.file = tempfile.TemporaryFile(prefix='pychat-', suffix='.log')
+        else:
+            self.file = open(path, 'w+b')
+        self.offsets = array.array('Q')
+        self.line_counts = array.array('L')
+        self.size = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, text, line_count):
+        """Write a chunk of lines at the end of the log"""
+        data = text.encode(ENCODING)
+        self.file.seek(self.size)
+        self.file.write(data)
+        self.offsets.append(self.size)
+        self.line_counts.append(line_count)
+        self.size += len(data)
+
+    def read(self, start, end):
+        """Read chunks start to end, end excluded, return (text, line_count)"""
+        offset = self.offsets[start]
+        size = (self.offsets[end] if end < len(self.offsets) else self.size) - offset
+        self.file.seek(offset)
+        return self.file.read(size).decode(ENCODING), sum(self.line_counts[start:end])
+
+    def close(self):
+        self.file.close()
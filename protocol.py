@@ -0,0 +1,134 @@
+"""Binary chat protocol v2, carried in the payload of length-prefixed frames
+
+Every v2 message starts with a short header, its body being the rest of the
+frame so that no length or delimiter has to be parsed out of the body:
+
+    type    u8      what the message is, one of the types below
+    flags   u8      per message options
+    sender  varint  id of the user (or channel) the message is from or about
+    target  varint  id of the user or channel the message is for, EVERYBODY for all
+
+Varints are little-endian base 128, so ids below 128 take a single byte.
+Users get an id when they set their pseudo and channels when they are
+created, the server reusing the smallest free ids so that they stay small.
+The pseudo or name going with each id is announced once (ROSTER, USER and
+CHANNEL messages), after which only ids are sent.
+v2 is negotiated like framing, by offering and picking it on the #proto= line;
+peers that don't pick it keep speaking the text protocol."""
+import struct
+
+from cipher import CTR, NONCE_SIZE
+from compression import DEFLATE
+from framing import FrameError, encode_frame
+
+V2 = 'v2'
+PREFIX = struct.Struct('>BB')
+
+# Target id of the messages meant for everybody
+EVERYBODY = 0
+
+# Message types, server to client
+MSG = 1         # sender sent body to target
+USER = 2        # user sender is now known as body (a pseudo)
+LEFT = 3        # user sender left the chat
+CHANNEL = 4     # channel body, just joined, has id sender
+ROSTER = 8      # body lists the id, flags and pseudo of every user there when the receiver arrived
+# Client to server, MSG too with its sender left to 0: the server knows who sent it
+PSEUDO = 5      # set own pseudo to body
+JOIN = 6        # join channel body
+PART = 7        # leave channel body
+
+# Flags of MSG messages
+ENCRYPTED = 0x01    # body is raw ciphertext, sent base64 encoded to text protocol peers
+SESSION_CTR = 0x02  # encrypted with a cipher.SessionCipher, body starts with the CTR header extension
+
+# Flags of USER messages and ROSTER entries: what the user's client can do
+CAN_DEFLATE = 0x01  # decompress bodies compressed with compression.compress
+CAN_CTR = 0x02      # decrypt messages encrypted with a cipher.SessionCipher
+
+# Capabilities picked on the #proto= line along with v2, and the user flag telling each of them
+CAPABILITIES = {DEFLATE: CAN_DEFLATE, CTR: CAN_CTR}
+
+_SMALL_VARINTS = [bytes((value,)) for value in range(0x80)]
+
+
+def encode_varint(value):
+    if value < 0x80:
+        return _SMALL_VARINTS[value]
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data, offset=0):
+    """Return (value, offset of the byte after it)"""
+    value = shift = 0
+    while True:
+        if offset >= len(data) or shift > 63:
+            raise FrameError('truncated or oversized varint in v2 message')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_message(kind, sender=0, target=0, body=b'', flags=0):
+    """Return the v2 payload for a message, not framed yet"""
+    return b''.join((PREFIX.pack(kind, flags), encode_varint(sender), encode_varint(target), body))
+
+
+def encode_message_frame(kind, sender=0, target=0, body=b'', flags=0):
+    """Return a v2 message ready for the wire"""
+    return encode_frame(encode_message(kind, sender, target, body, flags))
+
+
+def decode_message(payload):
+    """Return (type, flags, sender, target, body) from a v2 payload, body being a slice of payload"""
+    if len(payload) < PREFIX.size:
+        raise FrameError('v2 message of %d bytes is shorter than its header' % len(payload))
+    kind, flags = PREFIX.unpack_from(payload)
+    sender, offset = decode_varint(payload, PREFIX.size)
+    target, offset = decode_varint(payload, offset)
+    return kind, flags, sender, target, payload[offset:]
+
+
+def retarget(payload, target):
+    """Return a copy of a v2 payload with another target id"""
+    kind, flags, sender, _, body = decode_message(payload)
+    return encode_message(kind, sender, target, bytes(body), flags)
+
+
+def encode_ctr_extension(nonce, counter):
+    """Return the header extension of a SESSION_CTR message: session nonce and first counter block"""
+    return nonce + encode_varint(counter)
+
+
+def decode_ctr_extension(body):
+    """Return (nonce, counter, ciphertext) from the body of a SESSION_CTR message"""
+    if len(body) < NONCE_SIZE:
+        raise FrameError('session cipher message of %d bytes is shorter than its nonce' % len(body))
+    counter, offset = decode_varint(body, NONCE_SIZE)
+    return body[:NONCE_SIZE], counter, body[offset:]
+
+
+def encode_roster(users):
+    """Return the body of a ROSTER message from (id, pseudo bytes, flags) triples"""
+    return b''.join(encode_varint(user_id) + encode_varint(flags) + encode_varint(len(pseudo)) + pseudo
+                    for user_id, pseudo, flags in users)
+
+
+def decode_roster(body):
+    """Return the (id, pseudo bytes, flags) triples of a ROSTER message body"""
+    users, offset = [], 0
+    while offset < len(body):
+        user_id, offset = decode_varint(body, offset)
+        flags, offset = decode_varint(body, offset)
+        size, offset = decode_varint(body, offset)
+        users.append((user_id, bytes(body[offset:offset + size]), flags))
+        offset += size
+    return users
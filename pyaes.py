@@ -52,12 +52,16 @@
 
 
 import copy
+import functools
 import struct
 
 __all__ = ["AES", "AESModeOfOperationCTR", "AESModeOfOperationCBC", "AESModeOfOperationCFB",
            "AESModeOfOperationECB", "AESModeOfOperationOFB", "AESModesOfOperation", "Counter"]
 
 
+# Four big-endian 32-bit words, the layout of a 16 byte block for the word-level engine
+_block_words = struct.Struct('>4I')
+
 def _compact_word(word):
     return (word[0] << 24) | (word[1] << 16) | (word[2] << 8) | word[3]
 
@@ -70,6 +74,16 @@ def _bytes_to_string(binary):
 def _concat_list(a, b):
     return a + b
 
+def _string_to_buffer(text):
+    if isinstance(text, (bytes, bytearray, memoryview)):
+        return text
+    return bytes(bytearray(_string_to_bytes(text)))
+
+def _xor_bytes(a, b):
+    # XOR two equally long buffers as big integers, in C rather than per byte
+    size = len(a)
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(size, 'big')
+
 
 # Python 3 compatibility
 try:
@@ -200,6 +214,11 @@ class AES(object):
                                   self.U3[(tt >>  8) & 0xFF] ^
                                   self.U4[ tt        & 0xFF])
 
+        # Unsigned, immutable copies of the round keys for the word-level
+        # block engine (encrypt_block_into / decrypt_block_into)
+        self._Ke_words = tuple(tuple(k & 0xFFFFFFFF for k in round_key) for round_key in self._Ke)
+        self._Kd_words = tuple(tuple(k & 0xFFFFFFFF for k in round_key) for round_key in self._Kd)
+
     def encrypt(self, plaintext):
         'Encrypt a block of plain text using the AES block cipher.'
 
@@ -268,6 +287,68 @@ class AES(object):
 
         return result
 
+    def encrypt_block_into(self, block, out, offset = 0):
+        '''Encrypt the first 16 bytes of block into out[offset:offset + 16].
+
+           This is the word-level engine: the state lives in four 32-bit
+           locals, the four columns of every round are unrolled and nothing
+           is allocated besides the output. block may be any bytes-like
+           object (bytes, bytearray, memoryview) and out any writable buffer;
+           the result is identical to encrypt().'''
+
+        T1 = self.T1; T2 = self.T2; T3 = self.T3; T4 = self.T4
+        K = self._Ke_words
+
+        (s0, s1, s2, s3) = _block_words.unpack_from(block)
+        (k0, k1, k2, k3) = K[0]
+        s0 ^= k0; s1 ^= k1; s2 ^= k2; s3 ^= k3
+
+        # Apply round transforms
+        for (k0, k1, k2, k3) in K[1:-1]:
+            t0 = T1[s0 >> 24] ^ T2[(s1 >> 16) & 0xFF] ^ T3[(s2 >> 8) & 0xFF] ^ T4[s3 & 0xFF] ^ k0
+            t1 = T1[s1 >> 24] ^ T2[(s2 >> 16) & 0xFF] ^ T3[(s3 >> 8) & 0xFF] ^ T4[s0 & 0xFF] ^ k1
+            t2 = T1[s2 >> 24] ^ T2[(s3 >> 16) & 0xFF] ^ T3[(s0 >> 8) & 0xFF] ^ T4[s1 & 0xFF] ^ k2
+            s3 = T1[s3 >> 24] ^ T2[(s0 >> 16) & 0xFF] ^ T3[(s1 >> 8) & 0xFF] ^ T4[s2 & 0xFF] ^ k3
+            s0 = t0; s1 = t1; s2 = t2
+
+        # The last round is special
+        S = self.S
+        (k0, k1, k2, k3) = K[-1]
+        _block_words.pack_into(out, offset,
+            ((S[s0 >> 24] << 24) | (S[(s1 >> 16) & 0xFF] << 16) | (S[(s2 >> 8) & 0xFF] << 8) | S[s3 & 0xFF]) ^ k0,
+            ((S[s1 >> 24] << 24) | (S[(s2 >> 16) & 0xFF] << 16) | (S[(s3 >> 8) & 0xFF] << 8) | S[s0 & 0xFF]) ^ k1,
+            ((S[s2 >> 24] << 24) | (S[(s3 >> 16) & 0xFF] << 16) | (S[(s0 >> 8) & 0xFF] << 8) | S[s1 & 0xFF]) ^ k2,
+            ((S[s3 >> 24] << 24) | (S[(s0 >> 16) & 0xFF] << 16) | (S[(s1 >> 8) & 0xFF] << 8) | S[s2 & 0xFF]) ^ k3)
+
+    def decrypt_block_into(self, block, out, offset = 0):
+        '''Decrypt the first 16 bytes of block into out[offset:offset + 16].
+
+           Word-level counterpart of decrypt(); see encrypt_block_into().'''
+
+        T5 = self.T5; T6 = self.T6; T7 = self.T7; T8 = self.T8
+        K = self._Kd_words
+
+        (s0, s1, s2, s3) = _block_words.unpack_from(block)
+        (k0, k1, k2, k3) = K[0]
+        s0 ^= k0; s1 ^= k1; s2 ^= k2; s3 ^= k3
+
+        # Apply round transforms
+        for (k0, k1, k2, k3) in K[1:-1]:
+            t0 = T5[s0 >> 24] ^ T6[(s3 >> 16) & 0xFF] ^ T7[(s2 >> 8) & 0xFF] ^ T8[s1 & 0xFF] ^ k0
+            t1 = T5[s1 >> 24] ^ T6[(s0 >> 16) & 0xFF] ^ T7[(s3 >> 8) & 0xFF] ^ T8[s2 & 0xFF] ^ k1
+            t2 = T5[s2 >> 24] ^ T6[(s1 >> 16) & 0xFF] ^ T7[(s0 >> 8) & 0xFF] ^ T8[s3 & 0xFF] ^ k2
+            s3 = T5[s3 >> 24] ^ T6[(s2 >> 16) & 0xFF] ^ T7[(s1 >> 8) & 0xFF] ^ T8[s0 & 0xFF] ^ k3
+            s0 = t0; s1 = t1; s2 = t2
+
+        # The last round is special
+        Si = self.Si
+        (k0, k1, k2, k3) = K[-1]
+        _block_words.pack_into(out, offset,
+            ((Si[s0 >> 24] << 24) | (Si[(s3 >> 16) & 0xFF] << 16) | (Si[(s2 >> 8) & 0xFF] << 8) | Si[s1 & 0xFF]) ^ k0,
+            ((Si[s1 >> 24] << 24) | (Si[(s0 >> 16) & 0xFF] << 16) | (Si[(s3 >> 8) & 0xFF] << 8) | Si[s2 & 0xFF]) ^ k1,
+            ((Si[s2 >> 24] << 24) | (Si[(s1 >> 16) & 0xFF] << 16) | (Si[(s0 >> 8) & 0xFF] << 8) | Si[s3 & 0xFF]) ^ k2,
+            ((Si[s3 >> 24] << 24) | (Si[(s2 >> 16) & 0xFF] << 16) | (Si[(s1 >> 8) & 0xFF] << 8) | Si[s0 & 0xFF]) ^ k3)
+
 
 class Counter(object):
     '''A counter object for the Counter (CTR) mode of operation.
@@ -297,11 +378,49 @@ class Counter(object):
         else:
             self._counter = [ 0 ] * len(self._counter)
 
+    def blocks(self, count):
+        '''Return the next count counter values as 16 byte blocks and advance
+           the counter past them.
+
+           Custom counters that override increment() are stepped one value at
+           a time; the stock counter advances in a single integer addition.'''
+
+        if type(self).increment is not Counter.increment:
+            blocks = [ ]
+            for i in xrange(count):
+                blocks.append(bytes(bytearray(self.value)))
+                self.increment()
+            return blocks
+
+        size = len(self._counter)
+        mask = (1 << (8 * size)) - 1
+        value = int.from_bytes(bytes(bytearray(self._counter)), 'big')
+        blocks = [ ((value + i) & mask).to_bytes(size, 'big') for i in xrange(count) ]
+        self._counter = list(((value + count) & mask).to_bytes(size, 'big'))
+        return blocks
+
+
+# Number of expanded key schedules kept by _cached_aes
+KEY_SCHEDULE_CACHE_SIZE = 64
+
+@functools.lru_cache(maxsize = KEY_SCHEDULE_CACHE_SIZE)
+def _cached_aes(key):
+    # An AES instance is never modified after key expansion, so every mode
+    # object using the same key can share one
+    return AES(key)
+
 
 class AESBlockModeOfOperation(object):
-    '''Super-class for AES modes of operation that require blocks.'''
+    '''Super-class for AES modes of operation that require blocks.
+
+       key may be the raw key bytes, whose expanded schedule is looked up in
+       a bounded LRU cache shared by all modes, or an already built AES
+       instance, which makes creating a mode object nearly free.'''
     def __init__(self, key):
-        self._aes = AES(key)
+        if isinstance(key, AES):
+            self._aes = key
+        else:
+            self._aes = _cached_aes(bytes(key))
 
     def decrypt(self, ciphertext):
         raise Exception('not implemented')
@@ -495,28 +614,38 @@ class AESModeOfOperationOFB(AESStreamModeOfOperation):
 
     def __init__(self, key, iv = None):
         if iv is None:
-            self._last_precipherblock = [ 0 ] * 16
+            self._last_precipherblock = bytes(16)
         elif len(iv) != 16:
             raise ValueError('initialization vector must be 16 bytes')
         else:
-          self._last_precipherblock = _string_to_bytes(iv)
+          self._last_precipherblock = bytes(_string_to_buffer(iv))
 
-        self._remaining_block = [ ]
+        self._remaining_block = bytes()
 
         AESBlockModeOfOperation.__init__(self, key)
 
     def encrypt(self, plaintext):
-        encrypted = [ ]
-        for p in _string_to_bytes(plaintext):
-            if len(self._remaining_block) == 0:
-                self._remaining_block = self._aes.encrypt(self._last_precipherblock)
-                self._last_precipherblock = [ ]
-            precipherbyte = self._remaining_block.pop(0)
-            self._last_precipherblock.append(precipherbyte)
-            cipherbyte = p ^ precipherbyte
-            encrypted.append(cipherbyte)
-
-        return _bytes_to_string(encrypted)
+        plaintext = _string_to_buffer(plaintext)
+        size = len(plaintext)
+
+        # Use up the tail of the last keystream block first, then generate
+        # whole blocks, each one the encryption of the previous one
+        keystream = self._remaining_block
+        if len(keystream) < size:
+            count = (size - len(keystream) + 15) // 16
+            generated = bytearray(16 * count)
+            encrypt_block_into = self._aes.encrypt_block_into
+            block = self._last_precipherblock
+            view = memoryview(generated)
+            for offset in xrange(0, 16 * count, 16):
+                encrypt_block_into(block, generated, offset)
+                block = view[offset:offset + 16]
+            self._last_precipherblock = bytes(block)
+            keystream = keystream + generated
+
+        self._remaining_block = keystream[size:]
+
+        return _xor_bytes(plaintext, keystream[:size])
 
     def decrypt(self, ciphertext):
         # AES-OFB is symetric
@@ -560,19 +689,32 @@ class AESModeOfOperationCTR(AESStreamModeOfOperation):
             counter = Counter()
 
         self._counter = counter
-        self._remaining_counter = [ ]
+        self._remaining_counter = bytes()
+
+    def keystream(self, count):
+        '''Return the keystream for the next count counter blocks, generated
+           in one batch into a single preallocated buffer.'''
+
+        keystream = bytearray(16 * count)
+        encrypt_block_into = self._aes.encrypt_block_into
+        offset = 0
+        for block in self._counter.blocks(count):
+            encrypt_block_into(block, keystream, offset)
+            offset += 16
+        return keystream
 
     def encrypt(self, plaintext):
-        while len(self._remaining_counter) < len(plaintext):
-            self._remaining_counter += self._aes.encrypt(self._counter.value)
-            self._counter.increment()
+        plaintext = _string_to_buffer(plaintext)
+        size = len(plaintext)
 
-        plaintext = _string_to_bytes(plaintext)
+        # Top up the keystream left over from the previous call, if needed
+        keystream = self._remaining_counter
+        if len(keystream) < size:
+            keystream = keystream + self.keystream((size - len(keystream) + 15) // 16)
 
-        encrypted = [ (p ^ c) for (p, c) in zip(plaintext, self._remaining_counter) ]
-        self._remaining_counter = self._remaining_counter[len(encrypted):]
+        self._remaining_counter = keystream[size:]
 
-        return _bytes_to_string(encrypted)
+        return _xor_bytes(plaintext, keystream[:size])
 
     def decrypt(self, crypttext):
         # AES-CTR is symetric
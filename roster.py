@@ -0,0 +1,76 @@
+"""Ordered set of logins that reports every change as a row insert or delete"""
+import threading
+
+
+class Roster(object):
+    """Logins in arrival order, with an index map for O(1) membership and position lookups
+
+    Logins are any hashable key, e.g. the login itself or a numeric user id,
+    shown under a label that defaults to the login. With track_deltas, every
+    add and remove is recorded as a delta, ('insert', position, label) or
+    ('delete', position, label), so that a view can apply the changes one row
+    at a time instead of rebuilding itself. Deltas are collected by
+    take_deltas(), possibly from another thread; without a view to collect
+    them, they aren't recorded at all."""
+
+    def __init__(self, logins=(), track_deltas=True):
+        self.logins = []
+        self.positions = {}
+        self.labels = {}
+        self.deltas = []
+        self.track_deltas = track_deltas
+        self.lock = threading.Lock()
+        for login in logins:
+            self.add(login)
+
+    def __contains__(self, login):
+        return login in self.positions
+
+    def __len__(self):
+        return len(self.logins)
+
+    def __iter__(self):
+        return iter(list(self.logins))
+
+    def label(self, login):
+        return self.labels.get(login)
+
+    def add(self, login, label=None):
+        """Append login, return False if it was already there"""
+        with self.lock:
+            if login in self.positions:
+                return False
+            label = login if label is None else label
+            self.positions[login] = len(self.logins)
+            self.labels[login] = label
+            if self.track_deltas:
+                self.deltas.append(('insert', len(self.logins), label))
+            self.logins.append(login)
+            return True
+
+    def remove(self, login):
+        """Remove login, return False if it wasn't there"""
+        with self.lock:
+            position = self.positions.pop(login, None)
+            if position is None:
+                return False
+            del self.logins[position]
+            for index in range(position, len(self.logins)):
+                self.positions[self.logins[index]] = index
+            label = self.labels.pop(login)
+            if self.track_deltas:
+                self.deltas.append(('delete', position, label))
+            return True
+
+    def start_tracking(self):
+        """Record deltas from now on, starting with the insert of every login there already"""
+        with self.lock:
+            if not self.track_deltas:
+                self.track_deltas = True
+                self.deltas = [('insert', position, self.labels[login]) for position, login in enumerate(self.logins)]
+
+    def take_deltas(self):
+        """Return the changes made since the last call"""
+        with self.lock:
+            deltas, self.deltas = self.deltas, []
+            return deltas
@@ -0,0 +1,631 @@
+"""Asyncio chat server speaking the same wire protocol as server.js"""
+import argparse
+import asyncio
+import base64
+import collections
+import heapq
+import multiprocessing
+import signal
+
+import bus
+import protocol
+
+from cipher import CTR
+import compression
+from compression import DEFLATE
+
+from framing import CHANNELS, FRAMED, FrameDecoder, FrameError, PROTOCOL_MARKER, RECV_BUFFER_SIZE, encode_frame
+from framing import protocol_line, split_protocol_line
+from protocol import V2
+
+ENCODING = 'utf-8'
+HOST = '0.0.0.0'
+PORT = 5000
+BUFFER_SIZE = 1024
+
+# Outbound messages a connection may have pending before it is a slow consumer
+QUEUE_SIZE = 256
+# What to do with a slow consumer: drop the messages it can't take, or disconnect it
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect')
+# Protocols offered to clients in the welcome banner, on top of the text protocol
+PROTOCOLS = [FRAMED, V2, DEFLATE, CTR, CHANNELS]
+# Target of the messages meant for everybody
+EVERYBODY = 'ALL'
+# Targets starting with this are channels, joined with #join=<name> and left with #leave=<name>
+CHANNEL_PREFIX = '#'
+# v2 messages announcing the pseudo or channel name of an id, which is only ever told once
+ANNOUNCEMENTS = (protocol.USER, protocol.LEFT, protocol.CHANNEL, protocol.ROSTER)
+# Idle connections are closed after two hours, like server.js does
+TIMEOUT = 2 * 60 * 60
+
+
+class IdAllocator(object):
+    """Hands out the ids first, first + step, first + 2 * step... reusing the smallest released one first"""
+
+    def __init__(self, first=1, step=1):
+        self.next = first
+        self.step = step
+        self.free = []
+
+    def allocate(self):
+        if self.free:
+            return heapq.heappop(self.free)
+        value = self.next
+        self.next += self.step
+        return value
+
+    def release(self, value):
+        heapq.heappush(self.free, value)
+
+
+class OutgoingMessage(object):
+    """Data sent to one or many connections, encoded at most once per wire format
+
+    Every recipient is handed the very same bytes object: text connections the
+    payload itself, framed connections the payload with its length prefix and
+    v2 connections the v2 payload with its length prefix, the frames being
+    built the first time a recipient asks for them. A message with no payload
+    for a wire format isn't sent to the connections using it."""
+    __slots__ = ('payload', 'v2_payload', '_frame', '_v2_frame', 'stats')
+
+    def __init__(self, payload, stats, v2_payload=None):
+        self.payload = payload
+        self.v2_payload = v2_payload
+        self._frame = None
+        self._v2_frame = None
+        self.stats = stats
+        stats['messages'] += 1
+
+    @property
+    def frame(self):
+        if self._frame is None and self.payload is not None:
+            self._frame = encode_frame(self.payload)
+            self.stats['frames encoded'] += 1
+        return self._frame
+
+    @property
+    def v2_frame(self):
+        if self._v2_frame is None and self.v2_payload is not None:
+            self._v2_frame = encode_frame(self.v2_payload)
+            self.stats['v2 frames encoded'] += 1
+        return self._v2_frame
+
+
+class Connection(object):
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        # Id of the connection in protocol v2 messages, given along with its first pseudo
+        self.id = 0
+        peer = writer.get_extra_info('peername') or ('unknown', 0)
+        self.name = '%s:%s' % (peer[0], peer[1])
+        self.pseudo = None
+        # Encoded "<display name>> " put in front of every message of this connection
+        self.prefix = (self.name + "> ").encode(ENCODING)
+        self.channels = set()
+        self.framed = False
+        self.v2 = False
+        # Protocol v2 flags of the connection's user, telling what its client can do
+        self.flags = 0
+        self.decoder = None
+        self.queue = asyncio.Queue(maxsize=server.queue_size)
+        self.dropped = 0
+        self.closed = False
+        self.writer_task = None
+        # Idle connections are closed by watch_idle(), last_read being the loop time of the last read
+        self.loop = asyncio.get_running_loop()
+        self.last_read = self.loop.time()
+        self.idle_handle = None
+
+    @property
+    def display_name(self):
+        """Pseudo if one was set, connection name otherwise"""
+        return self.pseudo or self.name
+
+    def send(self, message, droppable=True):
+        """Enqueue a message (an OutgoingMessage or bytes) for this connection without ever blocking the sender
+
+        Messages that aren't droppable, the protocol negotiation ones and the v2 id announcements, are never
+        dropped: the connection is closed if its queue is full, whatever the slow consumer policy."""
+        if self.closed:
+            return
+        if not isinstance(message, OutgoingMessage):
+            message = OutgoingMessage(message, self.server.stats)
+        if self.v2:
+            data = message.v2_frame
+        elif self.framed:
+            data = message.frame
+        else:
+            data = message.payload
+        if data is None:
+            return
+        try:
+            self.queue.put_nowait(data)
+            self.server.stats['deliveries'] += 1
+        except asyncio.QueueFull:
+            if self.server.slow_consumer == 'drop' and droppable:
+                self.dropped += 1
+            else:
+                self.server.log('Disconnecting slow consumer ' + self.display_name)
+                self.close()
+
+    async def write_loop(self):
+        """Write queued data to the socket, waiting for it to drain between writes"""
+        try:
+            while True:
+                data = await self.queue.get()
+                self.writer.write(data)
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def close(self):
+        """Stop writing and close the socket, the read loop then ends the connection"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer_task:
+            self.writer_task.cancel()
+        if self.idle_handle:
+            self.idle_handle.cancel()
+        self.writer.close()
+
+    def watch_idle(self):
+        """Close the connection once nothing was read for TIMEOUT seconds
+
+        One timer per connection, pushed back when it fires if something was read meanwhile, rather than a
+        timeout per read."""
+        idle = self.loop.time() - self.last_read
+        if idle >= TIMEOUT:
+            self.server.log('Closing idle connection ' + self.display_name)
+            self.close()
+        else:
+            self.idle_handle = self.loop.call_later(TIMEOUT - idle, self.watch_idle)
+
+
+class ChatServer(object):
+    def __init__(self, host=HOST, port=PORT, queue_size=QUEUE_SIZE, slow_consumer='drop', verbose=False,
+                 route_private=True):
+        if slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError('slow consumer policy must be one of ' + ', '.join(SLOW_CONSUMER_POLICIES))
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.slow_consumer = slow_consumer
+        self.verbose = verbose
+        self.route_private = route_private
+        self.connections = set()
+        # Pseudo to connection index, used to deliver private messages to their recipient only
+        self.pseudos = {}
+        # Channel to subscribed connections
+        self.channels = {}
+        # Protocol v2 ids: id to connection or channel name, channel name to id
+        self.ids = {}
+        self.channel_ids = {}
+        self.id_allocator = IdAllocator()
+        self.server = None
+        # messages: built once for any number of recipients, frames encoded: length prefixes added to them,
+        # deliveries: messages queued to a connection, which never copies or encodes them again
+        self.stats = collections.Counter()
+
+        # Sharded mode: bus to the other workers, and where their pseudos and channel subscribers are.
+        # remote_pseudos maps a pseudo to (worker id, user id), remote_users a user id to (pseudo, flags)
+        self.bus = None
+        self.remote_pseudos = {}
+        self.remote_users = {}
+        self.remote_channels = {}
+
+    async def start(self, reuse_port=False):
+        """Start listening, return the asyncio server"""
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                 reuse_port=reuse_port)
+        return self.server
+
+    async def serve_forever(self, announce=True):
+        await self.start(reuse_port=self.bus is not None)
+        if announce:
+            print('Chat server running at %s:%d' % (self.host, self.port))
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def serve_worker(self, worker_bus):
+        """Serve as one of the workers of a sharded server, sharing the port with the others"""
+        self.bus = worker_bus
+        # Every worker hands ids out of its own residue class, so that they are unique across workers
+        workers = len(worker_bus.peers) + 1
+        self.id_allocator = IdAllocator(worker_bus.worker_id + 1, workers)
+        await worker_bus.start(self.on_bus_event)
+        await self.serve_forever(announce=False)
+
+    def log(self, message):
+        """Print message, text or encoded, with --verbose only: nothing is decoded otherwise"""
+        if self.verbose and message is not None:
+            if isinstance(message, bytes):
+                message = message.decode(ENCODING, 'replace')
+            print(message.rstrip('\r\n'))
+
+    async def handle_connection(self, reader, writer):
+        """Serve one client from connection to disconnection"""
+        connection = Connection(self, reader, writer)
+        connection.writer_task = asyncio.ensure_future(connection.write_loop())
+        connection.watch_idle()
+        self.on_connect(connection)
+        try:
+            while not connection.closed:
+                data = await reader.read(RECV_BUFFER_SIZE if connection.framed else BUFFER_SIZE)
+                if not data:
+                    break
+                connection.last_read = connection.loop.time()
+                if connection.framed:
+                    self.on_frames(connection, data)
+                else:
+                    self.on_data(connection, data)
+        except (ConnectionError, FrameError):
+            pass
+        finally:
+            self.on_disconnect(connection)
+
+    def on_connect(self, connection):
+        self.connections.add(connection)
+        connection.send(("Welcome " + connection.name +
+                         "\r\nPlease set your pseudo with #pseudo=my_pseudo\r\n").encode(ENCODING) +
+                        protocol_line(PROTOCOLS))
+        self.broadcast((connection.name + " joined the chat\r\n").encode(ENCODING), connection)
+
+    def on_data(self, connection, data):
+        """Handle a chunk received from a text client, each chunk being one message"""
+        if data.startswith(PROTOCOL_MARKER):
+            _, protocols, after = split_protocol_line(data)
+            if protocols is not None and FRAMED in protocols:
+                # Acknowledge in text, everything after it is framed both ways
+                picked = [FRAMED, V2] if V2 in protocols else [FRAMED]
+                if V2 in picked:
+                    for name, flag in protocol.CAPABILITIES.items():
+                        if name in protocols:
+                            picked.append(name)
+                            connection.flags |= flag
+                connection.send(protocol_line(picked), droppable=False)
+                connection.framed = True
+                connection.decoder = FrameDecoder()
+                if V2 in picked:
+                    connection.v2 = True
+                    self.send_roster(connection)
+                if after:
+                    self.on_frames(connection, after)
+                return
+        self.on_message(connection, data)
+
+    def on_frames(self, connection, data):
+        """Handle data received from a framed client, each frame being one message"""
+        connection.decoder.feed(data)
+        for frame in connection.decoder.frames():
+            if connection.v2:
+                self.on_v2_message(connection, frame)
+            else:
+                self.on_message(connection, bytes(frame))
+
+    def on_message(self, connection, data):
+        """Handle a message of the text protocol"""
+        if b'#pseudo=' in data:
+            pseudo = data.split(b'#pseudo=', 1)[1].decode(ENCODING, 'replace')
+            self.change_pseudo(connection, pseudo.replace('\r', '').replace('\n', ''))
+        elif data.startswith(b'#join='):
+            self.join_channel(connection, self.channel_name(data[len(b'#join='):]))
+        elif data.startswith(b'#leave='):
+            self.leave_channel(connection, self.channel_name(data[len(b'#leave='):]))
+        else:
+            fields = data.split(b';', 3)
+            if len(fields) < 4 or fields[0] != b'msg':
+                # Not a chat message, relayed as is to text clients only
+                self.route(connection, None, OutgoingMessage(connection.prefix + data, self.stats))
+            else:
+                target = fields[2].decode(ENCODING, 'replace')
+                self.route(connection, target, self.chat_message(connection, target, fields[3],
+                                                                 connection.prefix + data))
+
+    def on_v2_message(self, connection, payload):
+        """Handle a message of protocol v2"""
+        kind, flags, _, target_id, body = protocol.decode_message(payload)
+        if kind == protocol.MSG:
+            target = self.target_name(target_id)
+            if target is not None:
+                self.route(connection, target, self.chat_message(connection, target, bytes(body), flags=flags))
+        elif kind == protocol.PSEUDO:
+            self.change_pseudo(connection, bytes(body).decode(ENCODING, 'replace'))
+        elif kind == protocol.JOIN:
+            self.join_channel(connection, self.channel_name(bytes(body)))
+        elif kind == protocol.PART:
+            self.leave_channel(connection, self.channel_name(bytes(body)))
+
+    def target_name(self, target_id):
+        """Return the pseudo or channel a v2 target id is, None if it is unknown"""
+        if target_id == protocol.EVERYBODY:
+            return EVERYBODY
+        target = self.ids.get(target_id)
+        if isinstance(target, Connection):
+            return target.pseudo
+        return target or self.remote_users.get(target_id, (None,))[0]
+
+    def target_id(self, target):
+        """Return the v2 id of a pseudo or channel, None if it is unknown"""
+        if target == EVERYBODY:
+            return protocol.EVERYBODY
+        if target.startswith(CHANNEL_PREFIX):
+            # Workers number channels independently, the bus puts the local id in channel messages it delivers
+            return self.channel_ids.get(target, 0)
+        if target in self.pseudos:
+            return self.pseudos[target].id
+        if target in self.remote_pseudos:
+            return self.remote_pseudos[target][1]
+        return None
+
+    def chat_message(self, connection, target, body, text=None, flags=0):
+        """Build the chat message sent by connection to target in both protocols"""
+        if text is None:
+            if flags & protocol.SESSION_CTR:
+                # Only clients that picked CTR can decrypt it, and they all speak v2: no text form
+                text_body = None
+            elif flags & protocol.ENCRYPTED:
+                # The text protocol can't carry raw ciphertext
+                text_body = base64.b64encode(body)
+            else:
+                # Compressed for v2 recipients only, text peers (those without a pseudo too) get it as typed
+                text_body = compression.decompress(body)
+                if compression.is_compressed(text_body):
+                    text_body = None
+            if text_body is not None:
+                text = b''.join((connection.prefix, b'msg;', (connection.pseudo or '').encode(ENCODING), b';',
+                                 target.encode(ENCODING), b';', text_body))
+        target_id = self.target_id(target)
+        # v2 clients only know the users who have a pseudo, and a target unknown here can't be one of them
+        if target_id is None or not connection.id:
+            v2_payload = None
+        else:
+            v2_payload = protocol.encode_message(protocol.MSG, connection.id, target_id, body, flags)
+        return OutgoingMessage(text, self.stats, v2_payload)
+
+    def route(self, connection, target, message):
+        """Deliver a message from connection to target"""
+        if target is None or target == EVERYBODY:
+            self.broadcast(message, connection)
+        elif target.startswith(CHANNEL_PREFIX):
+            self.send_to_channel(target, message, connection)
+        elif self.route_private and (target in self.pseudos or target in self.remote_pseudos):
+            self.send_private(target, message, connection)
+        else:
+            self.broadcast(message, connection)
+
+    def change_pseudo(self, connection, pseudo):
+        """Set the pseudo of a connection and tell everybody"""
+        self.set_pseudo(connection, pseudo)
+        if not connection.id:
+            # No pseudo was ever set, v2 clients don't know of this connection: id 0 is EVERYBODY
+            v2_payload = None
+        elif pseudo:
+            v2_payload = protocol.encode_message(protocol.USER, connection.id, body=pseudo.encode(ENCODING),
+                                                 flags=connection.flags)
+        else:
+            # An empty pseudo can't be a target, v2 clients drop the user as if it left
+            v2_payload = protocol.encode_message(protocol.LEFT, connection.id)
+        # Announced once only, a v2 client missing it would never know who the id is
+        self.broadcast(OutgoingMessage((connection.name + " has now pseudo " + pseudo + "\r\n").encode(ENCODING),
+                                       self.stats, v2_payload),
+                       droppable=False)
+
+    def send_roster(self, connection):
+        """Tell a v2 connection the id of every user there already, in one message"""
+        users = [(other.id, other.pseudo, other.flags) for other in self.connections
+                 if other.pseudo and other is not connection]
+        users.extend((user_id, pseudo, flags) for user_id, (pseudo, flags) in self.remote_users.items())
+        body = protocol.encode_roster((user_id, pseudo.encode(ENCODING), flags) for user_id, pseudo, flags in users)
+        connection.send(OutgoingMessage(None, self.stats, protocol.encode_message(protocol.ROSTER, body=body)),
+                        droppable=False)
+
+    def set_pseudo(self, connection, pseudo):
+        old = connection.pseudo
+        if old and self.pseudos.get(old) is connection:
+            del self.pseudos[old]
+        connection.pseudo = pseudo
+        connection.prefix = (connection.display_name + "> ").encode(ENCODING)
+        if pseudo:
+            self.pseudos[pseudo] = connection
+            if not connection.id:
+                connection.id = self.id_allocator.allocate()
+                self.ids[connection.id] = connection
+        if self.bus:
+            self.bus.publish(bus.PSEUDO, (old or '').encode(ENCODING), (pseudo or '').encode(ENCODING),
+                             str(connection.id).encode(ENCODING), str(connection.flags).encode(ENCODING))
+
+    @staticmethod
+    def channel_name(data):
+        """Return the channel a #join=/#leave= command is about, None if the name is invalid"""
+        name = data.decode(ENCODING, 'replace').strip().lstrip(CHANNEL_PREFIX)
+        if not name or ';' in name or ' ' in name:
+            return None
+        return CHANNEL_PREFIX + name
+
+    def join_channel(self, connection, channel):
+        if channel:
+            if channel not in self.channels:
+                self.channels[channel] = set()
+                channel_id = self.id_allocator.allocate()
+                self.ids[channel_id] = channel
+                self.channel_ids[channel] = channel_id
+                if self.bus:
+                    self.bus.publish(bus.SUBSCRIBE, channel.encode(ENCODING))
+            self.channels[channel].add(connection)
+            connection.channels.add(channel)
+            if connection.v2:
+                connection.send(OutgoingMessage(None, self.stats, protocol.encode_message(
+                    protocol.CHANNEL, self.channel_ids[channel], body=channel.encode(ENCODING))), droppable=False)
+
+    def leave_channel(self, connection, channel):
+        subscribers = self.channels.get(channel)
+        if subscribers and connection in subscribers:
+            subscribers.remove(connection)
+            connection.channels.discard(channel)
+            if not subscribers:
+                del self.channels[channel]
+                channel_id = self.channel_ids.pop(channel)
+                del self.ids[channel_id]
+                self.id_allocator.release(channel_id)
+                if self.bus:
+                    self.bus.publish(bus.UNSUBSCRIBE, channel.encode(ENCODING))
+
+    def outgoing(self, data):
+        """Wrap data in an OutgoingMessage unless it already is one"""
+        return data if isinstance(data, OutgoingMessage) else OutgoingMessage(data, self.stats)
+
+    def send_to_channel(self, channel, data, sender=None):
+        """Send data to the subscribers of channel but the sender"""
+        message = self.outgoing(data)
+        for connection in self.channels.get(channel, ()):
+            if connection is not sender:
+                connection.send(message)
+        if self.bus and channel in self.remote_channels:
+            self.bus.publish(bus.CHANNEL, channel.encode(ENCODING), message.payload or b'', message.v2_payload or b'',
+                             peers=self.remote_channels[channel])
+        self.log(message.payload)
+
+    def send_private(self, pseudo, data, sender=None):
+        """Send data to the connection with that pseudo, wherever it is connected"""
+        message = self.outgoing(data)
+        recipient = self.pseudos.get(pseudo)
+        if recipient is not None:
+            if recipient is not sender:
+                recipient.send(message)
+        else:
+            self.bus.send(self.remote_pseudos[pseudo][0], bus.PRIVATE, pseudo.encode(ENCODING), message.payload or b'',
+                          message.v2_payload or b'')
+        self.log(message.payload)
+
+    def on_disconnect(self, connection):
+        connection.close()
+        if connection in self.connections:
+            self.connections.remove(connection)
+            name = connection.display_name
+            if connection.pseudo:
+                self.set_pseudo(connection, None)
+            for channel in list(connection.channels):
+                self.leave_channel(connection, channel)
+            left = protocol.encode_message(protocol.LEFT, connection.id) if connection.id else None
+            self.broadcast(OutgoingMessage((name + " left the chat.\r\n").encode(ENCODING), self.stats, left),
+                           droppable=False)
+            if connection.id:
+                # Only reused once everybody was told that it left
+                del self.ids[connection.id]
+                self.id_allocator.release(connection.id)
+
+    def broadcast(self, data, sender=None, droppable=True):
+        """Send data to every connection but the sender, encoding it once for all of them"""
+        message = self.outgoing(data)
+        for connection in self.connections:
+            if connection is not sender:
+                connection.send(message, droppable)
+        if self.bus:
+            self.bus.publish(bus.BROADCAST, message.payload or b'', message.v2_payload or b'', droppable=droppable)
+        self.log(message.payload)
+
+    def on_bus_event(self, worker_id, event, fields):
+        """Apply an event from another worker, only ever delivering to local connections"""
+        if event == bus.BROADCAST:
+            message = OutgoingMessage(fields[0] or None, self.stats, fields[1] or None)
+            # Id announcements of remote users are never dropped either
+            droppable = not fields[1] or fields[1][0] not in ANNOUNCEMENTS
+            for connection in self.connections:
+                connection.send(message, droppable)
+        elif event == bus.PRIVATE:
+            recipient = self.pseudos.get(fields[0].decode(ENCODING))
+            if recipient is not None:
+                recipient.send(OutgoingMessage(fields[1] or None, self.stats, fields[2] or None))
+        elif event == bus.CHANNEL:
+            channel = fields[0].decode(ENCODING)
+            if channel in self.channels:
+                v2_payload = fields[2] and protocol.retarget(fields[2], self.channel_ids[channel])
+                message = OutgoingMessage(fields[1] or None, self.stats, v2_payload or None)
+                for connection in self.channels[channel]:
+                    connection.send(message)
+        elif event == bus.PSEUDO:
+            old, new = fields[0].decode(ENCODING), fields[1].decode(ENCODING)
+            user_id, flags = int(fields[2]), int(fields[3])
+            if old and self.remote_pseudos.get(old, (None,))[0] == worker_id:
+                del self.remote_pseudos[old]
+            self.remote_users.pop(user_id, None)
+            if new:
+                self.remote_pseudos[new] = (worker_id, user_id)
+                self.remote_users[user_id] = (new, flags)
+        elif event == bus.SUBSCRIBE:
+            self.remote_channels.setdefault(fields[0].decode(ENCODING), set()).add(worker_id)
+        elif event == bus.UNSUBSCRIBE:
+            workers = self.remote_channels.get(fields[0].decode(ENCODING))
+            if workers:
+                workers.discard(worker_id)
+                if not workers:
+                    del self.remote_channels[fields[0].decode(ENCODING)]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Python Chat server')
+    parser.add_argument('--host', default=HOST, help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='outbound messages queued per client before it is a slow consumer '
+                             '(default: %(default)s)')
+    parser.add_argument('--slow-consumer', choices=SLOW_CONSUMER_POLICIES, default='drop',
+                        help='drop messages for slow clients or disconnect them (default: %(default)s)')
+    parser.add_argument('--verbose', action='store_true', help='log every message to stdout')
+    parser.add_argument('--broadcast-private', action='store_true',
+                        help='send private messages to every client, like server.js does')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes sharing the port with SO_REUSEPORT (default: %(default)s)')
+    return parser.parse_args(args)
+
+
+def create_server(options):
+    return ChatServer(options.host, options.port, options.queue_size, options.slow_consumer, options.verbose,
+                      not options.broadcast_private)
+
+
+def run_worker(options, worker_id, peers):
+    """Entry point of a worker process"""
+    try:
+        asyncio.run(create_server(options).serve_worker(bus.Bus(worker_id, peers)))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_sharded(options):
+    """Fork options.workers processes accepting connections on the same port, connected by a bus"""
+    mesh = bus.create_mesh(options.workers)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_worker, args=(options, worker_id, mesh[worker_id]))
+               for worker_id in range(options.workers)]
+    for worker in workers:
+        worker.start()
+    # Workers inherited their ends of the mesh
+    for peers in mesh:
+        for sock in peers.values():
+            sock.close()
+    print('Chat server running at %s:%d with %d workers' % (options.host, options.port, options.workers))
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    if options.workers > 1:
+        run_sharded(options)
+    else:
+        try:
+            asyncio.run(create_server(options).serve_forever())
+        except KeyboardInterrupt:
+            pass